@@ -1,18 +1,114 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin import SimpleListFilter
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Count
+from django.forms.models import BaseInlineFormSet
 
+from invoicer.currency import REPORTING_CURRENCY, client_receipts, convert_totals, symbol
 from invoicer.models import *
 
+# Filters on related rows only list the most-invoiced entries; any other
+# client or company can still be filtered on by id through the querystring
+# (e.g. ``?client=42``) or from the search box.
+FILTER_LIMIT = getattr(settings, "INVOICER_ADMIN_FILTER_LIMIT", 25)
+INLINE_PER_PAGE = getattr(settings, "INVOICER_ADMIN_INLINE_PER_PAGE", 20)
+
+class RelatedInvoiceListFilter(SimpleListFilter):
+    """
+    Lists at most ``FILTER_LIMIT`` related objects, ordered by how many
+    invoices they have, instead of enumerating the whole related table.
+    """
+    related_model = None
+
+    def lookups(self, request, model_admin):
+        related = self.related_model.objects.annotate(num_invoices=Count("invoices"))
+        related = related.filter(num_invoices__gt=0).order_by("-num_invoices")
+        lookups = [(unicode(obj.pk), unicode(obj)) for obj in related.only("id", "name")[:FILTER_LIMIT]]
+        # Keep the active choice visible even when it's outside the top
+        # entries. Lookups are built before ``value()`` is set, so read it
+        # from the querystring.
+        value = request.GET.get(self.parameter_name)
+        if value and value not in [pk for pk, name in lookups]:
+            try:
+                lookups.append((value, unicode(self.related_model.objects.only("id", "name").get(pk=value))))
+            except (self.related_model.DoesNotExist, ValueError):
+                pass
+        return lookups
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{"%s__id__exact" % self.parameter_name: self.value()})
+        return queryset
+
+class ClientListFilter(RelatedInvoiceListFilter):
+    title = "client"
+    parameter_name = "client"
+    related_model = Client
+
+class CompanyListFilter(RelatedInvoiceListFilter):
+    title = "company"
+    parameter_name = "company"
+    related_model = Company
+
 class LineItemInline(admin.TabularInline):
     model = LineItem
     fields = ("item", "name", "cost", "price", "quantity", "taxable")
 
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """
+    Only builds forms for one page of related objects. The inline's
+    ``get_formset`` sets ``page`` from the change view's querystring; the
+    counts and links its template shows come from the methods below.
+    """
+    per_page = INLINE_PER_PAGE
+    page = 1
+
+    def get_queryset(self):
+        if not hasattr(self, "_paginated_queryset"):
+            qs = super(PaginatedInlineFormSet, self).get_queryset()
+            self.count = qs.count()
+            self.pages = max((self.count + self.per_page - 1) // self.per_page, 1)
+            self.page = min(self.page, self.pages)
+            start = (self.page - 1) * self.per_page
+            self._paginated_queryset = qs[start:start + self.per_page]
+        return self._paginated_queryset
+
+    def has_previous(self):
+        self.get_queryset()
+        return self.page > 1
+
+    def has_next(self):
+        self.get_queryset()
+        return self.page < self.pages
+
+    def previous_page(self):
+        return self.page - 1
+
+    def next_page(self):
+        return self.page + 1
+
 class InvoiceInline(admin.TabularInline):
-    fields = ("invoice_date", "status", "due_date", "company", )
-    readonly_fields = ("invoice_date", "due_date", "company",)
+    fields = ("invoice_number", "invoice_date", "status", "due_date", "company", )
+    readonly_fields = ("invoice_number", "invoice_date", "due_date", "company",)
     model = Invoice
+    formset = PaginatedInlineFormSet
+    template = "admin/invoicer/client/invoice_inline.html"
     max_num = 0
     extra = 0
-    
+
+    def queryset(self, request):
+        qs = super(InvoiceInline, self).queryset(request)
+        return qs.select_related("company").order_by("-invoice_date", "-id")
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(InvoiceInline, self).get_formset(request, obj, **kwargs)
+        try:
+            page = max(int(request.GET.get("invoices_page", 1)), 1)
+        except ValueError:
+            page = 1
+        return type(formset.__name__, (formset,), {"page": page})
+
 class StylesheetInline(admin.StackedInline):
     model = Stylesheet
     extra = 1
@@ -21,7 +117,7 @@ class StylesheetInline(admin.StackedInline):
 class CompanyAdmin(admin.ModelAdmin):
     fieldsets = (
         (None, {
-            "fields": ("name", "numbering_prefix", "billing_email", "tax_rate"),
+            "fields": ("name", "numbering_prefix", "billing_email", "tax_rate", "currency"),
         },),
         ("Contact Info", {
             "fields": ("contact_person", "phone_number", "email", "website"),
@@ -33,27 +129,114 @@ class CompanyAdmin(admin.ModelAdmin):
     model = Company
     inlines = (StylesheetInline,)
 
+# Sorting needs every client's receipts in the reporting currency, so the
+# conversion is done in SQL, at the latest rate on or before each invoice
+# date (1 where there's none, as for the default currency). It's only added
+# to the query when the list is sorted on receipts.
+RECEIPTS_ORDER_SQL = """
+    SELECT COALESCE(SUM(li.price * li.quantity *
+        CASE WHEN li.taxable THEN (1 + co.tax_rate / 100) ELSE 1 END *
+        COALESCE((SELECT r.rate FROM invoicer_exchangerate r WHERE r.currency = %s
+            AND r.date <= inv.invoice_date ORDER BY r.date DESC LIMIT 1), 1) /
+        COALESCE((SELECT r.rate FROM invoicer_exchangerate r WHERE r.currency = inv.currency
+            AND r.date <= inv.invoice_date ORDER BY r.date DESC LIMIT 1), 1)), 0)
+    FROM invoicer_lineitem li
+    INNER JOIN invoicer_invoice inv ON li.invoice_id = inv.id
+    INNER JOIN invoicer_company co ON inv.company_id = co.id
+    WHERE inv.client_id = invoicer_client.id
+"""
+
+class ClientChangeList(ChangeList):
+    """
+    Totals the receipts of a page of clients with one grouped query,
+    converting each currency in bulk, instead of running
+    ``receipts_to_date`` per row.
+    """
+    def get_query_set(self, request):
+        qs = super(ClientChangeList, self).get_query_set(request)
+        if any(field.lstrip("-") == "receipts" for field in qs.query.order_by):
+            qs = qs.extra(select={"receipts": RECEIPTS_ORDER_SQL}, select_params=(REPORTING_CURRENCY,))
+        return qs
+
+    def get_results(self, request):
+        super(ClientChangeList, self).get_results(request)
+        receipts = client_receipts([obj.pk for obj in self.result_list])
+        for obj in self.result_list:
+            try:
+                obj.receipts = convert_totals(receipts.get(obj.pk, {}))
+            except ValueError:
+                # No exchange rate loaded for one of the client's invoices.
+                obj.receipts = None
+
 class ClientAdmin(admin.ModelAdmin):
     model = Client
     list_display = ("name", "email", "phone_number", "full_address", "receipts_to_date")
+    search_fields = ("name", "email", "project")
     inlines = (InvoiceInline,)
-    
+
+    def get_changelist(self, request, **kwargs):
+        return ClientChangeList
+
+    def receipts_to_date(self, obj):
+        if obj.receipts is None:
+            return "-"
+        return u"%s%s" % (symbol(REPORTING_CURRENCY), obj.receipts)
+    receipts_to_date.admin_order_field = "receipts"
+    receipts_to_date.short_description = "Receipts to date"
+
 class TermsAdmin(admin.ModelAdmin):
     model = Terms
-    
+
 class InvoiceAdmin(admin.ModelAdmin):
     model = Invoice
     list_display = ("invoice_number", "client", "company", "invoice_date", "due_date", "status",)
-    list_filter = ("client", "company", "invoice_date", "due_date", "status",)
+    list_filter = (ClientListFilter, CompanyListFilter, "invoice_date", "due_date", "status",)
     list_editable = ("status",)
-    search_fields = ("invoice_number",)
+    list_select_related = True
+    search_fields = ("invoice_number", "client__name",)
+    raw_id_fields = ("client",)
     fieldsets = (
-        (None, {"fields": (("company", "invoice_date",), ("client", "due_date",), "terms", ("status", "status_notes",), "invoice_number",)}),
+        (None, {"fields": (("company", "invoice_date",), ("client", "due_date",), "terms", ("status", "status_notes",), ("invoice_number", "currency",),)}),
     )
     inlines = (LineItemInline,)
 
+class InvoiceSnapshotAdmin(admin.ModelAdmin):
+    model = InvoiceSnapshot
+    list_display = ("invoice_number", "client", "company", "invoice_date", "total", "archived",)
+    list_filter = (ClientListFilter, CompanyListFilter, "invoice_date",)
+    list_select_related = True
+    search_fields = ("invoice_number",)
+    readonly_fields = ("invoice_number", "company", "client", "invoice_date", "status", "total", "archived",)
+    raw_id_fields = ("client",)
+
+    def has_add_permission(self, request):
+        return False
+
+class ChangeEventAdmin(admin.ModelAdmin):
+    model = ChangeEvent
+    list_display = ("id", "created", "username", "action", "model", "object_id", "invoice_id",)
+    list_filter = ("action", "model",)
+    search_fields = ("username",)
+    readonly_fields = ("created", "username", "action", "model", "object_id", "invoice_id", "company_id", "changes",)
+    exclude = ("user",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class ExchangeRateAdmin(admin.ModelAdmin):
+    model = ExchangeRate
+    list_display = ("date", "currency", "rate",)
+    list_filter = ("currency",)
+    date_hierarchy = "date"
+
 admin.site.register(Company, CompanyAdmin)
 admin.site.register(Client, ClientAdmin)
 admin.site.register(Invoice, InvoiceAdmin)
 admin.site.register(Terms, TermsAdmin)
 admin.site.register(Item)
+admin.site.register(InvoiceSnapshot, InvoiceSnapshotAdmin)
+admin.site.register(ChangeEvent, ChangeEventAdmin)
+admin.site.register(ExchangeRate, ExchangeRateAdmin)
@@ -0,0 +1,125 @@
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import router, transaction
+
+from invoicer.models import Invoice, InvoiceSnapshot
+from invoicer.rendering import render_invoice
+
+ARCHIVE_AFTER_DAYS = getattr(settings, "INVOICER_ARCHIVE_AFTER_DAYS", 90)
+
+def decimal_text(obj, name):
+    # Backends differ in whether trailing zeros survive the round trip.
+    places = obj._meta.get_field(name).decimal_places
+    return unicode(getattr(obj, name).quantize(Decimal(10) ** -places))
+
+def snapshot_data(invoice, lines):
+    """
+    The JSON-serializable header, lines and totals of an invoice.
+    """
+    subtotal = taxable = total = 0
+    for line in lines:
+        subtotal += line.ext_price()
+        total += line.total()
+        if line.taxable:
+            taxable += line.ext_price()
+    tax = (taxable * invoice.company.tax_rate / 100).quantize(Decimal('.01'))
+    return {
+        "invoice_number": invoice.invoice_number,
+        "invoice_date": invoice.invoice_date.isoformat(),
+        "due_date": invoice.due_date.isoformat(),
+        "status": invoice.status,
+        "status_notes": invoice.status_notes,
+        "currency": invoice.currency,
+        "company": {"id": invoice.company_id, "name": invoice.company.name,
+                    "tax_rate": decimal_text(invoice.company, "tax_rate")},
+        "client": {"id": invoice.client_id, "name": invoice.client.name},
+        "terms": {"name": invoice.terms.name, "description": invoice.terms.description},
+        "lines": [{
+            "name": line.name,
+            "description": line.description,
+            "price": decimal_text(line, "price"),
+            "quantity": decimal_text(line, "quantity"),
+            "taxable": line.taxable,
+            "ext_price": unicode(line.ext_price()),
+            "total": unicode(line.total()),
+        } for line in lines],
+        "totals": {"subtotal": unicode(subtotal), "tax": unicode(tax), "total": unicode(total)},
+    }
+
+def build_snapshot(invoice):
+    """
+    Freezes a paid invoice into an unsaved ``InvoiceSnapshot``, rendering
+    its page. Raises ``ValueError`` if the invoice isn't paid.
+    """
+    if invoice.status != "paid":
+        raise ValueError("Only paid invoices can be archived.")
+    lines = list(invoice.line_items.all())
+    for line in lines:
+        # Share the already loaded invoice and company instead of a query per line.
+        line.invoice = invoice
+    snapshot = InvoiceSnapshot(
+        invoice_number=invoice.invoice_number,
+        company=invoice.company,
+        client=invoice.client,
+        invoice_date=invoice.invoice_date,
+        status=invoice.status,
+    )
+    data = snapshot_data(invoice, lines)
+    snapshot.total = data["totals"]["total"]
+    snapshot.set_data(data)
+    snapshot.set_html(render_invoice(invoice, all_lines=True, archived=True))
+    return snapshot
+
+def archivable_invoices(days=ARCHIVE_AFTER_DAYS):
+    """
+    Paid invoices older than ``days`` that haven't been archived yet.
+    """
+    archived = InvoiceSnapshot.objects.values("invoice_number")
+    invoices = Invoice.objects.filter(status="paid", invoice_date__lt=date.today() - timedelta(days=days))
+    return invoices.exclude(invoice_number__in=archived).select_related().order_by("id")
+
+def archive_invoices(days=ARCHIVE_AFTER_DAYS, batch_size=100, prune=False):
+    """
+    Archives old paid invoices in batches of ``batch_size``, writing each
+    batch in one transaction. Yields ``(invoice, snapshot, error)`` for
+    every invoice; invoices whose page can't be rendered (e.g. because their
+    company has no stylesheet) are skipped with ``snapshot`` set to ``None``
+    and the reason in ``error``.
+    """
+    last_id = 0
+    while True:
+        batch = list(archivable_invoices(days).filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        last_id = batch[-1].id
+        results = []
+        for invoice in batch:
+            try:
+                results.append((invoice, build_snapshot(invoice), None))
+            except Exception as e:
+                results.append((invoice, None, u"%s: %s" % (type(e).__name__, e)))
+        with transaction.commit_on_success(using=router.db_for_write(InvoiceSnapshot)):
+            for invoice, snapshot, error in results:
+                if snapshot is not None:
+                    snapshot.save()
+                    if prune:
+                        invoice.delete()
+        for result in results:
+            yield result
+
+def prune_archived(batch_size=100):
+    """
+    Removes invoices from the working tables that were archived without
+    ``prune``. Returns the number of invoices removed.
+    """
+    archived = InvoiceSnapshot.objects.values("invoice_number")
+    pruned = 0
+    while True:
+        ids = list(Invoice.objects.filter(invoice_number__in=archived).values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return pruned
+        with transaction.commit_on_success(using=router.db_for_write(Invoice)):
+            Invoice.objects.filter(id__in=ids).delete()
+        pruned += len(ids)
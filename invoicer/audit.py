@@ -0,0 +1,156 @@
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models, router
+from django.db.models.signals import post_delete, post_init, post_save
+
+# Bookkeeping columns that change on every write and aren't worth an event.
+IGNORED_FIELDS = ("id", "version")
+
+# Event ids are handed out when rows are inserted, not when they commit, so
+# a lower id can become visible after a higher one. Readers only get events
+# older than this many seconds, by which time their transaction is over.
+SETTLE_SECONDS = getattr(settings, "INVOICER_CHANGE_SETTLE_SECONDS", 10)
+
+_state = threading.local()
+
+def begin(user=None):
+    """
+    Starts buffering change events for the current thread, attributing them
+    to ``user``. Called by ``ChangeEventMiddleware`` at the start of a request.
+    """
+    _state.user = user
+    _state.buffer = []
+    _state.companies = {}
+
+def flush():
+    """
+    Writes the buffered events with a single bulk insert per database and
+    stops buffering. Each event goes to the database it was routed to when
+    it was recorded, as the active company may be gone by now, e.g. after
+    a failed request.
+    """
+    from invoicer.models import ChangeEvent
+    buffered = getattr(_state, "buffer", None) or []
+    _state.buffer = None
+    _state.user = None
+    _state.companies = {}
+    # Stamp the events with the time they're inserted rather than built,
+    # so the settle window only has to cover the commit.
+    now = datetime.now()
+    events = []
+    by_database = defaultdict(list)
+    for using, event in buffered:
+        event.created = now
+        events.append(event)
+        by_database[using].append(event)
+    for using, batch in by_database.items():
+        ChangeEvent.objects.using(using).bulk_create(batch)
+    return events
+
+def settled(events, after, limit):
+    """
+    Up to ``limit`` of ``events`` after the ``after`` cursor, stopping at
+    the first one younger than ``SETTLE_SECONDS``. Events after it aren't
+    returned either, as moving the cursor past them could skip an earlier
+    id that hasn't committed yet.
+    """
+    cutoff = datetime.now() - timedelta(seconds=SETTLE_SECONDS)
+    batch = []
+    for event in events.filter(id__gt=after).order_by("id")[:limit]:
+        if event.created >= cutoff:
+            break
+        batch.append(event)
+    return batch
+
+def jsonable(value, field=None):
+    if isinstance(value, Decimal):
+        if isinstance(field, models.DecimalField):
+            # Log the field's precision whatever the backend trimmed off.
+            value = value.quantize(Decimal(10) ** -field.decimal_places)
+        return unicode(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+def tracked_values(instance):
+    return dict((f.attname, getattr(instance, f.attname)) for f in instance._meta.fields
+        if f.attname not in IGNORED_FIELDS)
+
+def company_for(invoice_id):
+    """
+    The company of an invoice, memoized for the request so a batch of line
+    changes only looks it up once.
+    """
+    from invoicer.models import Invoice
+    companies = getattr(_state, "companies", None)
+    if companies is None:
+        companies = {}
+    if invoice_id not in companies:
+        found = Invoice.objects.filter(pk=invoice_id).values_list("company_id", flat=True)[:1]
+        companies[invoice_id] = found[0] if found else None
+    return companies[invoice_id]
+
+def record(model, object_id, action, changes, invoice_id=None, company_id=None):
+    """
+    Records a change to a row. ``changes`` maps field names to ``(old, new)``
+    pairs. Buffered during a request, written straight away otherwise.
+    """
+    from invoicer.models import ChangeEvent
+    if not changes and action == "update":
+        return None
+    if company_id is None and invoice_id is not None:
+        company_id = company_for(invoice_id)
+    user = getattr(_state, "user", None)
+    event = ChangeEvent(
+        user=user,
+        username=user.username if user is not None else "",
+        model=model._meta.object_name.lower(),
+        object_id=object_id,
+        invoice_id=invoice_id,
+        company_id=company_id,
+        action=action,
+    )
+    fields = dict((f.attname, f) for f in model._meta.fields)
+    event.set_changes(dict((name, [jsonable(old, fields.get(name)), jsonable(new, fields.get(name))])
+        for name, (old, new) in changes.items()))
+    buffer = getattr(_state, "buffer", None)
+    if buffer is None:
+        event.save()
+    else:
+        buffer.append((router.db_for_write(ChangeEvent), event))
+    return event
+
+def invoice_ids(sender, instance):
+    if sender._meta.object_name == "Invoice":
+        return instance.pk, instance.company_id
+    return instance.invoice_id, None
+
+def remember(sender, instance, **kwargs):
+    instance._audit_original = tracked_values(instance)
+
+def saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    current = tracked_values(instance)
+    original = {} if created else getattr(instance, "_audit_original", {})
+    changes = dict((name, (original.get(name), value)) for name, value in current.items()
+        if created or original.get(name) != value)
+    invoice_id, company_id = invoice_ids(sender, instance)
+    record(sender, instance.pk, created and "create" or "update", changes, invoice_id, company_id)
+    instance._audit_original = current
+
+def deleted(sender, instance, **kwargs):
+    changes = dict((name, (value, None)) for name, value in tracked_values(instance).items())
+    invoice_id, company_id = invoice_ids(sender, instance)
+    record(sender, instance.pk, "delete", changes, invoice_id, company_id)
+
+def register(*models):
+    for model in models:
+        uid = "invoicer.audit.%s" % model.__name__
+        post_init.connect(remember, sender=model, dispatch_uid=uid)
+        post_save.connect(saved, sender=model, dispatch_uid=uid)
+        post_delete.connect(deleted, sender=model, dispatch_uid=uid)
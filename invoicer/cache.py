@@ -0,0 +1,194 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import router
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+
+ENTITY_CACHE = getattr(settings, "INVOICER_ENTITY_CACHE", {})
+TIMEOUT = ENTITY_CACHE.get("TIMEOUT", 300)
+MAX_ENTRIES = ENTITY_CACHE.get("MAX_ENTRIES", 1000)
+BACKEND = ENTITY_CACHE.get("BACKEND", None)
+FRAGMENT_TIMEOUT = ENTITY_CACHE.get("FRAGMENT_TIMEOUT", TIMEOUT)
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+class LRUCache(object):
+    """
+    A small thread-safe, in-process LRU cache whose entries expire after
+    ``timeout`` seconds.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, timeout=TIMEOUT):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # Re-insert so the entry becomes the most recently used.
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.timeout, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+local_cache = LRUCache()
+_shared_cache = []
+
+# django.core.cache connects to the default backend as soon as it's
+# imported, so it's only imported once a cache is actually used.
+def shared_cache():
+    if BACKEND is None:
+        return None
+    if not _shared_cache:
+        from django.core.cache import get_cache
+        _shared_cache.append(get_cache(BACKEND))
+    return _shared_cache[0]
+
+def fragment_cache():
+    from django.core.cache import cache
+    return cache
+
+# Keys include the database alias, as ``invoicer.routers.CompanyRouter`` can
+# put rows with the same primary key in different databases.
+def entity_key(model, pk, using):
+    return "invoicer:%s:%s:%s" % (using, model._meta.object_name.lower(), pk)
+
+def stylesheet_key(company_id, using):
+    return "invoicer:%s:company_stylesheet:%s" % (using, company_id)
+
+def version_key(name, pk, using):
+    return "invoicer:%s:version:%s:%s" % (using, name, pk)
+
+def new_version():
+    # Time based, so a version key that gets evicted and recreated never
+    # matches fragments cached under an older value.
+    return int(time.time() * 1000)
+
+def bump_version(name, pk, using):
+    fragment_cache().set(version_key(name, pk, using), new_version(), VERSION_TIMEOUT)
+
+def fragment_versions(invoice, stylesheet):
+    """
+    The current versions of the objects ``invoice.html`` caches fragments
+    for, keyed by name. Fragments are cached under these versions, so
+    bumping one on save retires the fragments built from the old row.
+    """
+    using = invoice._state.db
+    keys = {
+        "company": version_key("company", invoice.company_id, using),
+        "client": version_key("client", invoice.client_id, using),
+        "terms": version_key("terms", invoice.terms_id, using),
+        "stylesheet": version_key("stylesheet", stylesheet.pk, using),
+    }
+    fragments = fragment_cache()
+    found = fragments.get_many(keys.values())
+    versions = {}
+    for name, key in keys.items():
+        if key not in found:
+            fragments.add(key, new_version(), VERSION_TIMEOUT)
+            found[key] = fragments.get(key)
+        versions[name] = found[key]
+    return versions
+
+def cached(key, load):
+    """
+    Reads ``key`` through the local and shared caches, calling ``load`` on a
+    miss. Callers get a copy, so changes they make never leak into the cache.
+    """
+    value = local_cache.get(key)
+    if value is None:
+        shared = shared_cache()
+        if shared is not None:
+            value = shared.get(key)
+        if value is None:
+            value = load()
+            if shared is not None:
+                shared.set(key, value, TIMEOUT)
+        local_cache.set(key, value)
+    return copy.copy(value)
+
+def invalidate(key):
+    local_cache.delete(key)
+    shared = shared_cache()
+    if shared is not None:
+        shared.delete(key)
+
+def get_entity(model, pk):
+    """
+    Returns the ``model`` instance with primary key ``pk`` from the cache,
+    loading it from the database on a miss. Raises ``model.DoesNotExist``.
+    """
+    try:
+        pk = int(pk)
+    except (TypeError, ValueError):
+        raise model.DoesNotExist
+    using = router.db_for_read(model)
+    return cached(entity_key(model, pk, using), lambda: model.objects.using(using).get(pk=pk))
+
+def get_entity_or_404(model, pk):
+    try:
+        return get_entity(model, pk)
+    except model.DoesNotExist:
+        raise Http404
+
+def get_company_stylesheet(company):
+    def load():
+        return company.stylesheets.all()[0]
+    return cached(stylesheet_key(company.pk, company._state.db), load)
+
+def attach_entities(invoice):
+    """
+    Fills in an invoice's company, client and terms from the cache instead
+    of joining them in the invoice query.
+    """
+    from invoicer.models import Client, Company, Terms
+    invoice.company = get_entity(Company, invoice.company_id)
+    invoice.client = get_entity(Client, invoice.client_id)
+    invoice.terms = get_entity(Terms, invoice.terms_id)
+    return invoice
+
+def invalidate_entity(sender, instance, using=None, **kwargs):
+    using = using or instance._state.db
+    invalidate(entity_key(sender, instance.pk, using))
+    bump_version(sender._meta.object_name.lower(), instance.pk, using)
+
+def invalidate_stylesheet(sender, instance, using=None, **kwargs):
+    using = using or instance._state.db
+    invalidate(stylesheet_key(instance.company_id, using))
+    bump_version("stylesheet", instance.pk, using)
+
+def register(entities, stylesheet):
+    """
+    Drops cached entries whenever the rows behind them change. Other
+    processes only notice once their local entries expire, so keep
+    ``TIMEOUT`` short when running several without a shared backend.
+    """
+    for model in entities:
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate_entity, sender=model,
+                dispatch_uid="invoicer.cache.%s.%s" % (model.__name__, id(signal)))
+    for signal in (post_save, post_delete):
+        signal.connect(invalidate_stylesheet, sender=stylesheet,
+            dispatch_uid="invoicer.cache.stylesheet.%s" % id(signal))
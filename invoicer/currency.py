@@ -0,0 +1,212 @@
+import bisect
+import csv
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models.signals import post_delete, post_save
+
+from invoicer.cache import LRUCache, TIMEOUT
+
+# Exchange rates are quoted as units of a currency per unit of the default
+# currency, which is also what new companies bill in.
+DEFAULT_CURRENCY = getattr(settings, "INVOICER_DEFAULT_CURRENCY", "USD")
+REPORTING_CURRENCY = getattr(settings, "INVOICER_REPORTING_CURRENCY", DEFAULT_CURRENCY)
+
+SYMBOLS = {
+    "USD": u"$",
+    "CAD": u"CA$",
+    "AUD": u"A$",
+    "EUR": u"\u20ac",
+    "GBP": u"\xa3",
+    "JPY": u"\xa5",
+}
+SYMBOLS.update(getattr(settings, "INVOICER_CURRENCY_SYMBOLS", {}))
+
+CENT = Decimal('.01')
+
+# Rates are cached a whole day at a time, so converting a batch of amounts
+# costs at most one query for the days that aren't cached yet.
+rate_cache = LRUCache(max_entries=1000, timeout=TIMEOUT)
+
+def symbol(currency):
+    return SYMBOLS.get(currency, u"%s " % currency)
+
+def rate_dates():
+    from invoicer.models import ExchangeRate
+    dates = rate_cache.get("dates")
+    if dates is None:
+        dates = sorted(ExchangeRate.objects.values_list("date", flat=True).distinct())
+        rate_cache.set("dates", dates)
+    return dates
+
+def effective_date(day):
+    """
+    The latest date on or before ``day`` that rates were loaded for.
+    """
+    dates = rate_dates()
+    i = bisect.bisect_right(dates, day)
+    if not i:
+        return None
+    return dates[i - 1]
+
+def rates_for(days):
+    """
+    Returns ``{day: {currency: rate}}`` for each of ``days``, falling back
+    to the closest earlier day with rates.
+    """
+    from invoicer.models import ExchangeRate
+    effective = dict((day, effective_date(day)) for day in set(days))
+    missing = [d for d in set(effective.values()) if d is not None and rate_cache.get(d) is None]
+    if missing:
+        loaded = defaultdict(dict)
+        for day, currency, rate in ExchangeRate.objects.filter(date__in=missing).values_list("date", "currency", "rate"):
+            loaded[day][currency] = rate
+        for day in missing:
+            rate_cache.set(day, dict(loaded[day]))
+    result = {}
+    for day, rate_day in effective.items():
+        rates = dict(rate_day and rate_cache.get(rate_day) or {})
+        rates[DEFAULT_CURRENCY] = Decimal(1)
+        result[day] = rates
+    return result
+
+def get_rate(rates, currency, day):
+    try:
+        return rates[currency]
+    except KeyError:
+        raise ValueError("No %s exchange rate on or before %s." % (currency, day))
+
+def convert_totals(amounts, currency=REPORTING_CURRENCY):
+    """
+    Converts ``{(currency, day): amount}`` into a single total in
+    ``currency``, fetching the rates for all the days at once. Raises
+    ``ValueError`` if a rate is missing.
+    """
+    rates = rates_for([day for from_currency, day in amounts if from_currency != currency])
+    total = Decimal(0)
+    for (from_currency, day), amount in amounts.items():
+        if from_currency != currency:
+            day_rates = rates[day]
+            amount = amount / get_rate(day_rates, from_currency, day) * get_rate(day_rates, currency, day)
+            amount = amount.quantize(CENT)
+        total += amount
+    return total
+
+def line_receipts(client_ids):
+    """
+    Every listed client's receipts, split by invoice currency and date.
+    Each line is rounded like ``LineItem.total``, so the totals match the
+    invoices to the cent. Returns ``{client_id: {(currency, date): amount}}``.
+    """
+    from invoicer.models import LineItem
+    lines = LineItem.objects.filter(invoice__client__in=client_ids).values_list(
+        "invoice__client", "invoice__currency", "invoice__invoice_date",
+        "price", "quantity", "taxable", "invoice__company__tax_rate")
+    receipts = defaultdict(lambda: defaultdict(Decimal))
+    for client_id, currency, day, price, quantity, taxable, tax_rate in lines:
+        total = (price * quantity).quantize(CENT)
+        if taxable:
+            total = (total * (tax_rate/100 + 1)).quantize(CENT)
+        receipts[client_id][(currency, day)] += total
+    return receipts
+
+GROUPED_RECEIPTS_SQL = """
+    SELECT inv.client_id, inv.currency, inv.invoice_date, li.taxable, co.tax_rate,
+        SUM(li.price * li.quantity)
+    FROM invoicer_lineitem li
+    INNER JOIN invoicer_invoice inv ON li.invoice_id = inv.id
+    INNER JOIN invoicer_company co ON inv.company_id = co.id
+    WHERE inv.client_id IN (%s)
+    GROUP BY inv.client_id, inv.currency, inv.invoice_date, li.taxable, co.tax_rate
+"""
+
+def to_decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+def to_date(value):
+    # Some backends hand raw queries' dates back as strings.
+    return value if isinstance(value, date) else datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+def client_receipts(client_ids):
+    """
+    Like ``line_receipts``, but summed by the database, one row per client,
+    currency, date and tax rate. Tax is applied to each group rather than
+    each line, so totals can be a few cents off ``line_receipts``; meant for
+    listings, where reading every line would be too slow.
+    """
+    from invoicer.models import LineItem
+    receipts = defaultdict(lambda: defaultdict(Decimal))
+    if not client_ids:
+        return receipts
+    cursor = connections[router.db_for_read(LineItem)].cursor()
+    cursor.execute(GROUPED_RECEIPTS_SQL % ", ".join(["%s"] * len(client_ids)), list(client_ids))
+    for client_id, currency, day, taxable, tax_rate, amount in cursor.fetchall():
+        amount = to_decimal(amount)
+        if taxable:
+            amount = amount * (to_decimal(tax_rate)/100 + 1)
+        receipts[client_id][(currency, to_date(day))] += amount.quantize(CENT)
+    return receipts
+
+def receipts_by_client(client_ids, currency=REPORTING_CURRENCY):
+    """
+    Each client's receipts to date converted into ``currency``.
+    """
+    receipts = line_receipts(client_ids)
+    return dict((client_id, convert_totals(receipts.get(client_id, {}), currency))
+        for client_id in client_ids)
+
+def read_rates(path):
+    """
+    Yields ``(date, currency, rate)`` from a CSV file of
+    ``YYYY-MM-DD,CUR,rate`` rows. Blank lines and ``#`` comments are skipped.
+    """
+    with open(path, "rb") as f:
+        for number, row in enumerate(csv.reader(f), 1):
+            if not row or not "".join(row).strip() or row[0].startswith("#"):
+                continue
+            try:
+                day, currency, rate = [value.strip() for value in row]
+                yield datetime.strptime(day, "%Y-%m-%d").date(), currency.upper(), Decimal(rate)
+            except (ValueError, InvalidOperation):
+                raise ValueError("%s:%d: expected date,currency,rate but got %r" % (path, number, row))
+
+def load_rates(rates, batch_size=1000):
+    """
+    Stores ``(date, currency, rate)`` tuples, replacing any rates already
+    loaded for the same day and currency. Each batch is written in its own
+    transaction with one bulk insert.
+    """
+    from invoicer.models import ExchangeRate
+    rates = iter(rates)
+    loaded = 0
+    while True:
+        batch = {}
+        for day, currency, rate in rates:
+            batch[(day, currency)] = rate
+            if len(batch) >= batch_size:
+                break
+        if not batch:
+            break
+        by_day = defaultdict(list)
+        for day, currency in batch:
+            by_day[day].append(currency)
+        with transaction.commit_on_success(using=router.db_for_write(ExchangeRate)):
+            for day, currencies in by_day.items():
+                ExchangeRate.objects.filter(date=day, currency__in=currencies).delete()
+            ExchangeRate.objects.bulk_create([ExchangeRate(date=day, currency=currency, rate=rate)
+                for (day, currency), rate in batch.items()])
+        loaded += len(batch)
+    # bulk_create doesn't send post_save.
+    rate_cache.clear()
+    return loaded
+
+def clear_rates(sender, **kwargs):
+    rate_cache.clear()
+
+def register(exchange_rate):
+    for signal in (post_save, post_delete):
+        signal.connect(clear_rates, sender=exchange_rate,
+            dispatch_uid="invoicer.currency.%s" % id(signal))
@@ -1,5 +1,4 @@
 from django.forms import ModelForm
-from django.forms.models import inlineformset_factory
 
 from invoicer.models import *
 
@@ -10,9 +9,3 @@ class InvoiceForm(ModelForm):
 class LineItemForm(ModelForm):
     class Meta:
         model = LineItem
-
-LineItemFormset = inlineformset_factory(
-    Invoice, LineItem,
-    fields=('name', 'description', 'price', 'quantity', 'taxable',),
-    extra=0
-)
\ No newline at end of file
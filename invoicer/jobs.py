@@ -0,0 +1,149 @@
+import traceback
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.utils.importlib import import_module
+
+RENDER_IN_BACKGROUND = getattr(settings, "INVOICER_RENDER_IN_BACKGROUND", False)
+RENDER_TIMEOUT = getattr(settings, "INVOICER_RENDER_TIMEOUT", 600)
+PDF_RENDERER = getattr(settings, "INVOICER_PDF_RENDERER", None)
+
+def get_pdf_renderer():
+    """
+    Loads the callable named by ``INVOICER_PDF_RENDERER``, which takes the
+    rendered HTML and the invoice and returns the PDF's bytes.
+    """
+    if not PDF_RENDERER:
+        return None
+    module, attr = PDF_RENDERER.rsplit(".", 1)
+    return getattr(import_module(module), attr)
+
+def enqueue(invoice_id):
+    """
+    Schedules an invoice to be re-rendered and marks its current artifact
+    stale. Does nothing if a render is already pending for it.
+    """
+    if not RENDER_IN_BACKGROUND:
+        return
+    from invoicer.models import Invoice, InvoiceArtifact, RenderJob
+    if not Invoice.objects.filter(pk=invoice_id).exists():
+        # The invoice is being deleted along with its lines.
+        return
+    if not RenderJob.objects.filter(invoice=invoice_id, status="pending").exists():
+        RenderJob.objects.create(invoice_id=invoice_id)
+    # Flag the artifact only after the job exists; see ``run``.
+    InvoiceArtifact.objects.filter(invoice=invoice_id).update(stale=True)
+
+def fresh_artifact(invoice):
+    """
+    Returns the invoice's artifact if it's up to date, otherwise ``None``.
+    """
+    if not RENDER_IN_BACKGROUND:
+        return None
+    from invoicer.models import InvoiceArtifact
+    try:
+        return InvoiceArtifact.objects.get(invoice=invoice, stale=False)
+    except InvoiceArtifact.DoesNotExist:
+        return None
+
+def claim(limit=10):
+    """
+    Claims the oldest pending job. The conditional UPDATE makes sure only one
+    of several workers racing for the same job gets it.
+    """
+    from invoicer.models import RenderJob
+    for job in RenderJob.objects.filter(status="pending").order_by("id")[:limit]:
+        claimed = RenderJob.objects.filter(pk=job.pk, status="pending").update(
+            status="running", started=datetime.now(), attempts=models.F("attempts") + 1)
+        if claimed:
+            job.status = "running"
+            return job
+    return None
+
+def requeue_abandoned():
+    """
+    Puts back jobs whose worker died while rendering them.
+    """
+    from invoicer.models import RenderJob
+    cutoff = datetime.now() - timedelta(seconds=RENDER_TIMEOUT)
+    return RenderJob.objects.filter(status="running", started__lt=cutoff).update(status="pending")
+
+def run(job):
+    """
+    Renders the job's invoice and stores the result as its artifact.
+    """
+    from invoicer.cache import attach_entities
+    from invoicer.models import Invoice, InvoiceArtifact, RenderJob
+    from invoicer.rendering import render_invoice
+    try:
+        invoice = attach_entities(Invoice.objects.get(pk=job.invoice_id))
+        html = render_invoice(invoice, all_lines=True)
+        renderer = get_pdf_renderer()
+        # Render before touching the stored artifact, so a failing renderer
+        # leaves the previous PDF in place and still named by the row.
+        pdf = renderer(html, invoice) if renderer is not None else None
+        artifact, created = InvoiceArtifact.objects.get_or_create(invoice=invoice)
+        artifact.html = html
+        artifact.rendered = datetime.now()
+        artifact.stale = False
+        old_pdf = None
+        if pdf is not None:
+            old_pdf = artifact.pdf.name
+            artifact.pdf.save("%s.pdf" % invoice.invoice_number, ContentFile(pdf), save=False)
+        artifact.save()
+        if old_pdf and old_pdf != artifact.pdf.name:
+            # Only drop the old file once the row names the new one.
+            artifact.pdf.storage.delete(old_pdf)
+        # Changes made while we were rendering have queued another job;
+        # checking after the save means we can't clobber their stale flag.
+        if RenderJob.objects.filter(invoice=invoice, status="pending").exists():
+            InvoiceArtifact.objects.filter(pk=artifact.pk).update(stale=True)
+    except Exception:
+        RenderJob.objects.filter(pk=job.pk).update(status="failed",
+            finished=datetime.now(), error=traceback.format_exc())
+        return False
+    RenderJob.objects.filter(pk=job.pk).update(status="done", finished=datetime.now())
+    RenderJob.objects.filter(invoice=job.invoice_id, status__in=("done", "failed"),
+        id__lt=job.pk).delete()
+    return True
+
+def invoice_changed(sender, instance, **kwargs):
+    enqueue(instance.pk)
+
+def line_changed(sender, instance, **kwargs):
+    enqueue(instance.invoice_id)
+
+def entity_changed(sender, instance, **kwargs):
+    # Rendered pages embed the company's, client's and terms' details.
+    # Re-rendering every invoice referencing them at once would flood the
+    # queue, so their artifacts are only marked stale and rebuilt as they're
+    # viewed. The invoice's foreign keys are named after the models.
+    from invoicer.models import InvoiceArtifact
+    field = "invoice__%s" % sender._meta.object_name.lower()
+    InvoiceArtifact.objects.filter(**{field: instance.pk}).update(stale=True)
+
+def stylesheet_changed(sender, instance, **kwargs):
+    from invoicer.models import InvoiceArtifact
+    InvoiceArtifact.objects.filter(invoice__company=instance.company_id).update(stale=True)
+
+def register(invoice, line_item, entities, stylesheet):
+    """
+    Queues renders whenever an invoice or its lines change, and marks
+    artifacts stale when the company, client, terms or stylesheet they show
+    change, if ``INVOICER_RENDER_IN_BACKGROUND`` is on.
+    """
+    if not RENDER_IN_BACKGROUND:
+        return
+    post_save.connect(invoice_changed, sender=invoice, dispatch_uid="invoicer.jobs.invoice")
+    post_save.connect(line_changed, sender=line_item, dispatch_uid="invoicer.jobs.line_saved")
+    post_delete.connect(line_changed, sender=line_item, dispatch_uid="invoicer.jobs.line_deleted")
+    for model in entities:
+        for signal in (post_save, post_delete):
+            signal.connect(entity_changed, sender=model,
+                dispatch_uid="invoicer.jobs.%s.%s" % (model.__name__, id(signal)))
+    for signal in (post_save, post_delete):
+        signal.connect(stylesheet_changed, sender=stylesheet,
+            dispatch_uid="invoicer.jobs.stylesheet.%s" % id(signal))
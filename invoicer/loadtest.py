@@ -0,0 +1,315 @@
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.signals import got_request_exception
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError, connection, connections
+from django.db.backends.util import CursorWrapper
+from django.test.client import Client as TestClient
+
+from invoicer.models import Client, Company, Invoice, LineItem, Stylesheet, Terms
+
+PREFIX = "LOAD"
+USERNAME = "invoicer-loadtest"
+PASSWORD = "invoicer-loadtest"
+
+ACTIONS = ("view", "edit", "add")
+
+# Statements that take write locks. Time spent in them and in commits is
+# where concurrent writers queue up behind each other.
+WRITES = ("INSERT", "UPDATE", "DELETE")
+
+# Substrings of the errors databases raise when a statement gave up waiting
+# for a lock: SQLite, PostgreSQL and MySQL respectively.
+LOCK_ERRORS = ("database is locked", "deadlock detected", "could not obtain lock",
+    "lock wait timeout", "deadlock found")
+
+def seed(invoices=10, lines=20):
+    """
+    Creates (or reuses) a company whose invoices are only used for load
+    testing, tops it up to ``invoices`` invoices of ``lines`` lines each,
+    and makes sure the staff user the workers log in as exists. Returns the
+    company and the invoices' numbers.
+    """
+    company, created = Company.objects.get_or_create(numbering_prefix=PREFIX,
+        defaults={"name": "Load Test", "tax_rate": Decimal("8.25")})
+    if created:
+        Stylesheet.objects.create(company=company, name="Load Test",
+            description="Load test stylesheet", stylesheet="invoicer/loadtest.css")
+    client, created = Client.objects.get_or_create(name="Load Test Client")
+    terms, created = Terms.objects.get_or_create(name="Load Test Terms",
+        defaults={"description": "Due on receipt."})
+    existing = Invoice.objects.filter(company=company).count()
+    for i in range(existing, invoices):
+        invoice = Invoice.objects.create(company=company, client=client, terms=terms, status="unsent")
+        LineItem.objects.bulk_create([LineItem(invoice=invoice, name="Line %d" % n,
+            description="Seeded line", price=Decimal("10.00"), quantity=Decimal("1.00"),
+            taxable=bool(n % 2), position=(n + 1) * 1024, version=1) for n in range(lines)])
+    try:
+        user = User.objects.get(username=USERNAME)
+    except User.DoesNotExist:
+        user = User(username=USERNAME, is_staff=True)
+    user.set_password(PASSWORD)
+    user.save()
+    numbers = Invoice.objects.filter(company=company).order_by("id").values_list("invoice_number", flat=True)
+    return company, list(numbers[:invoices])
+
+def unseed():
+    """
+    Removes everything ``seed`` created.
+    """
+    Company.objects.filter(numbering_prefix=PREFIX).delete()
+    Client.objects.filter(name="Load Test Client", invoices=None).delete()
+    Terms.objects.filter(name="Load Test Terms", invoice=None).delete()
+    User.objects.filter(username=USERNAME).delete()
+
+# Signals are delivered in the thread that sent them, so each worker
+# thread records the exceptions of its own requests.
+_failure = threading.local()
+
+def remember_failure(sender, **kwargs):
+    _failure.error = sys.exc_info()[1]
+
+class WorkerClient(TestClient):
+    """
+    A test client that leaves exceptions to ``remember_failure``. The stock
+    client's receiver is connected under one fixed ``dispatch_uid`` for every
+    client in the process, so with several threads it can re-raise one
+    worker's exception in another.
+    """
+    def store_exc_info(self, **kwargs):
+        pass
+
+class TimedCursor(object):
+    """
+    Wraps a cursor, adding the time its write statements take to the
+    worker's ``waited`` total.
+    """
+    def __init__(self, cursor, worker):
+        self.cursor = cursor
+        self.worker = worker
+
+    def timed(self, method, sql, params):
+        if sql.lstrip()[:6].upper() not in WRITES:
+            return method(sql, params)
+        start = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            self.worker.waited += time.time() - start
+
+    def execute(self, sql, params=()):
+        return self.timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def classify(error):
+    if isinstance(error, DatabaseError):
+        message = unicode(error).lower()
+        if any(text in message for text in LOCK_ERRORS):
+            return "lock"
+    return "error"
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+class Stats(object):
+    """
+    Thread-safe tallies of a load test's outcomes, by action.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.waits = defaultdict(list)
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def add(self, action, seconds, waited, outcome):
+        with self.lock:
+            self.latencies[action].append(seconds)
+            self.waits[action].append(waited)
+            self.counts[action][outcome] += 1
+
+    def summary(self, elapsed):
+        """
+        Requests, throughput, latency and lock wait percentiles (ms) and
+        outcome counts for each action and for all of them together.
+        """
+        rows = []
+        everything = []
+        all_waits = []
+        for action in ACTIONS + ("total",):
+            if action == "total":
+                latencies, waits, counts = everything, all_waits, defaultdict(int)
+                for action_counts in self.counts.values():
+                    for outcome, count in action_counts.items():
+                        counts[outcome] += count
+            else:
+                latencies, counts = self.latencies.get(action, []), self.counts.get(action, {})
+                waits = self.waits.get(action, [])
+                everything.extend(latencies)
+                all_waits.extend(waits)
+            if not latencies:
+                continue
+            ordered = sorted(latencies)
+            waited = sorted(waits)
+            requests = len(ordered)
+            rows.append({
+                "action": action,
+                "requests": requests,
+                "per_second": requests / elapsed if elapsed else 0.0,
+                "p50": percentile(ordered, .5) * 1000,
+                "p90": percentile(ordered, .9) * 1000,
+                "p99": percentile(ordered, .99) * 1000,
+                "max": ordered[-1] * 1000,
+                "wait_p50": percentile(waited, .5) * 1000,
+                "wait_p90": percentile(waited, .9) * 1000,
+                "conflicts": counts.get("conflict", 0),
+                "lock_errors": counts.get("lock", 0),
+                "errors": counts.get("error", 0),
+                "error_rate": float(counts.get("lock", 0) + counts.get("error", 0)) / requests,
+            })
+        return rows
+
+class Worker(threading.Thread):
+    """
+    Plays one member of staff: logs in with its own test client and keeps
+    viewing, editing and adding lines to random invoices until ``deadline``.
+    Like the invoice page, it remembers the version of each line it last
+    saw and edits against it. Time spent in write statements and commits,
+    which is where it waits for other workers' locks, is added up in
+    ``waited``.
+    """
+    def __init__(self, company, numbers, lines, stats, deadline, weights):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.company = company
+        self.numbers = numbers
+        self.stats = stats
+        self.deadline = deadline
+        self.weights = weights
+        # {line id: (invoice number, version, displayed price)}
+        self.lines = dict(lines)
+        self.waited = 0.0
+
+    def time_writes(self):
+        # Connections are per thread, so this only affects the worker's own.
+        for alias in connections:
+            wrapper = connections[alias]
+            wrapper.use_debug_cursor = True
+            wrapper.make_debug_cursor = lambda cursor, wrapper=wrapper: TimedCursor(
+                CursorWrapper(cursor, wrapper), self)
+            wrapper._commit = self.timed_commit(wrapper._commit)
+
+    def timed_commit(self, commit):
+        def timed():
+            start = time.time()
+            try:
+                return commit()
+            finally:
+                self.waited += time.time() - start
+        return timed
+
+    def login(self):
+        self.client = WorkerClient()
+        self.client.login(username=USERNAME, password=PASSWORD)
+        session = self.client.session
+        session["invoicer_company"] = self.company.pk
+        session.save()
+
+    def choose(self):
+        point = random.uniform(0, sum(self.weights))
+        for action, weight in zip(ACTIONS, self.weights):
+            point -= weight
+            if point <= 0:
+                return action
+        return ACTIONS[-1]
+
+    def view(self):
+        number = random.choice(self.numbers)
+        response = self.client.get(reverse("invoicer:invoice", kwargs={"id": number}))
+        return response.status_code == 200 and "ok" or "error"
+
+    def edit(self):
+        line_id = random.choice(list(self.lines))
+        number, version, price = self.lines[line_id]
+        value = "%.2f" % random.uniform(1, 100)
+        response = self.client.post(reverse("invoicer:edit_invoice", kwargs={"id": number}), {
+            "field": "price", "value": value, "original": price, "version": version,
+            "line": line_id, "element_id": "line-%s-price" % line_id,
+        }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        if response.status_code != 200:
+            return "error"
+        data = json.loads(response.content)
+        if data["status"] == "success":
+            self.lines[line_id] = (number, data["version"], data["value"])
+            return "ok"
+        if data["status"] == "conflict":
+            # Pick up the other editor's change, as the page would.
+            self.lines[line_id] = (number, data["version"], data["cells"]["price"])
+            return "conflict"
+        return "error"
+
+    def add(self):
+        number = random.choice(self.numbers)
+        response = self.client.post(reverse("invoicer:add_line", kwargs={"id": number}), {
+            "name": "Added line", "description": "Added under load", "price": "5.00",
+            "quantity": "2", "taxable": "on",
+        })
+        return response.status_code == 302 and "ok" or "error"
+
+    def run(self):
+        self.time_writes()
+        self.login()
+        try:
+            while time.time() < self.deadline:
+                action = self.choose()
+                _failure.error = None
+                self.waited = 0.0
+                start = time.time()
+                try:
+                    outcome = getattr(self, action)()
+                except Exception as e:
+                    _failure.error = e
+                if _failure.error is not None:
+                    outcome = classify(_failure.error)
+                    # Don't carry an aborted transaction into the next request.
+                    connection.close()
+                self.stats.add(action, time.time() - start, self.waited, outcome)
+        finally:
+            connection.close()
+
+def run(company, numbers, workers=10, duration=30, weights=(6, 3, 1)):
+    """
+    Runs ``workers`` concurrent workers against the seeded invoices for
+    ``duration`` seconds and returns the ``Stats`` summary.
+    """
+    lines = [(pk, (number, version, "%.2f" % price)) for pk, number, version, price in
+        LineItem.objects.filter(invoice__invoice_number__in=numbers).values_list(
+            "id", "invoice__invoice_number", "version", "price")]
+    got_request_exception.connect(remember_failure, dispatch_uid="invoicer.loadtest")
+    stats = Stats()
+    start = time.time()
+    deadline = start + duration
+    threads = [Worker(company, numbers, lines, stats, deadline, weights) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    got_request_exception.disconnect(dispatch_uid="invoicer.loadtest")
+    return stats.summary(elapsed)
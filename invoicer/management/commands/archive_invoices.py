@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from invoicer.archive import ARCHIVE_AFTER_DAYS, archive_invoices, prune_archived
+from invoicer.tenancy import company_databases, use_database
+
+class Command(BaseCommand):
+    help = "Archives paid invoices into compressed snapshots, optionally pruning them from the working tables."
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", dest="days", default=ARCHIVE_AFTER_DAYS,
+            help="Only archive invoices dated more than this many days ago."),
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+            help="Number of invoices archived per transaction."),
+        make_option("--prune", action="store_true", dest="prune", default=False,
+            help="Remove archived invoices and their lines from the working tables."),
+        make_option("--database", dest="database", default=None,
+            help="Only archive invoices in this database. By default the default database "
+                 "and each of INVOICER_COMPANY_DATABASES are archived in turn."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        databases = [options["database"]] if options["database"] else company_databases()
+        try:
+            for alias in databases:
+                use_database(alias)
+                self.archive(alias, verbosity, **options)
+        finally:
+            use_database(None)
+
+    def archive(self, alias, verbosity, **options):
+        archived = skipped = 0
+        for invoice, snapshot, error in archive_invoices(options["days"], options["batch_size"], options["prune"]):
+            if snapshot is None:
+                skipped += 1
+                if verbosity:
+                    self.stderr.write("Skipped invoice %s: %s\n" % (invoice.invoice_number, error))
+                continue
+            archived += 1
+            if verbosity > 1:
+                self.stdout.write("Archived invoice %s\n" % snapshot.invoice_number)
+        pruned = 0
+        if options["prune"]:
+            # Catch up on invoices archived earlier without --prune.
+            pruned = prune_archived(options["batch_size"])
+        if verbosity:
+            self.stdout.write("Archived %d invoices in %s, skipped %d, pruned %d previously archived.\n" % (
+                archived, alias, skipped, pruned))
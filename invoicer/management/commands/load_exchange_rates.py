@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicer.currency import load_rates, read_rates
+
+class Command(BaseCommand):
+    args = "<file.csv file.csv ...>"
+    help = "Loads exchange rates from CSV files of date,currency,rate rows, replacing rates already loaded for the same day."
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Number of rates written per transaction."),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError("Give at least one file of exchange rates.")
+        verbosity = int(options.get("verbosity", 1))
+        for path in paths:
+            try:
+                loaded = load_rates(read_rates(path), options["batch_size"])
+            except (IOError, ValueError) as e:
+                raise CommandError(unicode(e))
+            if verbosity:
+                self.stdout.write("Loaded %d exchange rates from %s\n" % (loaded, path))
@@ -0,0 +1,52 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicer.loadtest import run, seed, unseed
+
+COLUMNS = ("action", "requests", "per_second", "p50", "p90", "p99", "max",
+    "wait_p50", "wait_p90", "conflicts", "lock_errors", "errors", "error_rate")
+
+class Command(BaseCommand):
+    help = ("Drives view_invoice, edit_invoice and add_line with concurrent workers against "
+            "seeded invoices and reports throughput, latency and lock wait percentiles (ms), "
+            "edit conflicts, lock errors and error rates. Run it against a scratch database.")
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=10,
+            help="Number of concurrent workers."),
+        make_option("--duration", type="float", dest="duration", default=30,
+            help="Seconds to run for."),
+        make_option("--invoices", type="int", dest="invoices", default=10,
+            help="Number of invoices the workers share; fewer means more contention."),
+        make_option("--lines", type="int", dest="lines", default=20,
+            help="Number of lines seeded on each invoice."),
+        make_option("--mix", dest="mix", default="6,3,1",
+            help="Relative weights of views, edits and added lines."),
+        make_option("--json", action="store_true", dest="json", default=False,
+            help="Print the results as JSON instead of a table."),
+        make_option("--cleanup", action="store_true", dest="cleanup", default=False,
+            help="Delete the seeded company, invoices and user afterwards."),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            weights = [float(weight) for weight in options["mix"].split(",")]
+        except ValueError:
+            weights = []
+        if len(weights) != 3 or min(weights) < 0 or not sum(weights):
+            raise CommandError("--mix takes three weights, e.g. 6,3,1.")
+        company, numbers = seed(options["invoices"], options["lines"])
+        try:
+            rows = run(company, numbers, options["workers"], options["duration"], weights)
+        finally:
+            if options["cleanup"]:
+                unseed()
+        if options["json"]:
+            self.stdout.write(json.dumps(rows, indent=2) + "\n")
+            return
+        self.stdout.write("%-7s %9s %8s %8s %8s %8s %8s %8s %8s %9s %11s %7s %10s\n" % (
+            ("action", "requests", "req/s") + COLUMNS[3:]))
+        for row in rows:
+            self.stdout.write("%-7s %9d %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %9d %11d %7d %9.2f%%\n" % (
+                tuple(row[column] for column in COLUMNS[:-1]) + (row["error_rate"] * 100,)))
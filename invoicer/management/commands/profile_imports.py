@@ -0,0 +1,66 @@
+import os
+import pkgutil
+import subprocess
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import invoicer
+
+# Run in a fresh interpreter for every measurement, as a module is only
+# really imported once per process. Settings and the parts of Django every
+# process loads anyway are imported before the clock starts.
+TIMER = """
+import sys, time
+from django.conf import settings
+settings.INSTALLED_APPS
+import django.db.models, django.http
+before = len(sys.modules)
+start = time.time()
+__import__(%r)
+sys.stdout.write("%%f %%d\\n" %% (time.time() - start, len(sys.modules) - before))
+"""
+
+def invoicer_modules():
+    path = os.path.dirname(invoicer.__file__)
+    names = ["invoicer"]
+    for loader, name, is_package in pkgutil.walk_packages([path], "invoicer."):
+        if not name.startswith("invoicer.migrations"):
+            names.append(name)
+    return names
+
+def time_import(name):
+    # manage.py may have put the project on sys.path itself, so hand the
+    # child the whole path rather than relying on its environment.
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    process = subprocess.Popen([sys.executable, "-c", TIMER % name],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = process.communicate()
+    if process.returncode:
+        raise CommandError("Importing %s failed:\n%s" % (name, err))
+    seconds, loaded = out.split()
+    return float(seconds), int(loaded)
+
+class Command(BaseCommand):
+    args = "<module module ...>"
+    help = ("Reports how long each invoicer module takes to import in a fresh process, "
+            "including everything it pulls in, slowest first.")
+    option_list = BaseCommand.option_list + (
+        make_option("--repeat", type="int", dest="repeat", default=3,
+            help="Number of fresh processes to time each module in; the fastest run is reported."),
+    )
+
+    def handle(self, *names, **options):
+        names = names or invoicer_modules()
+        results = []
+        for name in names:
+            runs = [time_import(name) for i in range(max(options["repeat"], 1))]
+            seconds, loaded = min(runs)
+            results.append((seconds, loaded, name))
+        results.sort(reverse=True)
+        width = max(len(name) for name in names)
+        self.stdout.write("%s %10s %8s\n" % ("module".ljust(width), "ms", "modules"))
+        for seconds, loaded, name in results:
+            self.stdout.write("%s %10.1f %8d\n" % (name.ljust(width), seconds * 1000, loaded))
@@ -0,0 +1,64 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections, reset_queries
+
+from invoicer.jobs import claim, requeue_abandoned, run
+from invoicer.tenancy import company_databases, use_database
+
+class Command(BaseCommand):
+    help = "Runs a worker that pre-renders invoices queued for rendering. Several can run side by side."
+    option_list = BaseCommand.option_list + (
+        make_option("--once", action="store_true", dest="once", default=False,
+            help="Exit once the queue is empty instead of waiting for more jobs."),
+        make_option("--interval", type="float", dest="interval", default=2.0,
+            help="Seconds to wait between polls of an empty queue."),
+        make_option("--database", dest="database", default=None,
+            help="Only render jobs queued in this database. By default the worker takes "
+                 "turns between the default database and each of INVOICER_COMPANY_DATABASES."),
+    )
+
+    def requeue(self, databases, verbosity):
+        for alias in databases:
+            use_database(alias)
+            requeued = requeue_abandoned()
+            if requeued and verbosity:
+                self.stdout.write("Requeued %d abandoned jobs in %s.\n" % (requeued, alias))
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        databases = [options["database"]] if options["database"] else company_databases()
+        rendered = failed = 0
+        try:
+            self.requeue(databases, verbosity)
+            while True:
+                idle = True
+                for alias in databases:
+                    use_database(alias)
+                    job = claim()
+                    if job is None:
+                        continue
+                    idle = False
+                    if run(job):
+                        rendered += 1
+                        if verbosity > 1:
+                            self.stdout.write("Rendered invoice %s in %s\n" % (job.invoice_id, alias))
+                    else:
+                        failed += 1
+                        if verbosity:
+                            self.stderr.write("Failed to render invoice %s in %s\n" % (job.invoice_id, alias))
+                    reset_queries()
+                if not idle:
+                    continue
+                if options["once"]:
+                    break
+                # Don't hold connections (and transactions) open while idle.
+                for alias in databases:
+                    connections[alias].close()
+                time.sleep(options["interval"])
+                self.requeue(databases, 0)
+        finally:
+            use_database(None)
+        if verbosity:
+            self.stdout.write("Rendered %d invoices, %d failed.\n" % (rendered, failed))
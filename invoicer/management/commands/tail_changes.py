@@ -0,0 +1,46 @@
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, reset_queries
+
+from invoicer.audit import settled
+from invoicer.models import ChangeEvent
+
+class Command(BaseCommand):
+    help = "Prints invoice change events after a cursor as JSON lines, optionally following new ones."
+    option_list = BaseCommand.option_list + (
+        make_option("--after", type="int", dest="after", default=0,
+            help="Only print events with an id greater than this cursor."),
+        make_option("--batch-size", type="int", dest="batch_size", default=500,
+            help="Number of events read per query."),
+        make_option("--invoice", type="int", dest="invoice", default=None,
+            help="Only print events for this invoice id."),
+        make_option("--follow", action="store_true", dest="follow", default=False,
+            help="Keep waiting for new events instead of exiting at the end."),
+        make_option("--interval", type="float", dest="interval", default=2.0,
+            help="Seconds to wait between polls when following."),
+        make_option("--database", dest="database", default=DEFAULT_DB_ALIAS,
+            help="Database to read events from. Each of INVOICER_COMPANY_DATABASES "
+                 "keeps its own log, with its own cursors."),
+    )
+
+    def handle(self, *args, **options):
+        cursor = options["after"]
+        events = ChangeEvent.objects.using(options["database"])
+        if options["invoice"]:
+            events = events.filter(invoice_id=options["invoice"])
+        while True:
+            batch = settled(events, cursor, options["batch_size"])
+            for event in batch:
+                self.stdout.write(json.dumps(event.as_dict(), separators=(',',':')) + "\n")
+            if batch:
+                cursor = batch[-1].id
+                self.stdout.flush()
+                reset_queries()
+                continue
+            if not options["follow"]:
+                break
+            connections[options["database"]].close()
+            time.sleep(options["interval"])
@@ -0,0 +1,41 @@
+from invoicer import audit
+from invoicer.tenancy import (NO_COMPANY, REQUIRE_COMPANY, activate, clean_company_id,
+    deactivate, get_resolver)
+
+class ActiveCompanyMiddleware(object):
+    """
+    Activates the company returned by ``INVOICER_COMPANY_RESOLVER`` for the
+    duration of each request, scoping invoicer's querysets to it. Must come
+    after the session and authentication middleware.
+    """
+    def __init__(self):
+        self.resolver = get_resolver()
+
+    def process_request(self, request):
+        company_id = clean_company_id(self.resolver(request))
+        if company_id is None and REQUIRE_COMPANY:
+            company_id = NO_COMPANY
+        activate(company_id)
+
+    def process_response(self, request, response):
+        deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        deactivate()
+
+class ChangeEventMiddleware(object):
+    """
+    Buffers the change events of each request, attributed to its user, and
+    writes them with one bulk insert once the response is ready. Must come
+    after the authentication middleware.
+    """
+    def process_request(self, request):
+        user = getattr(request, "user", None)
+        if user is not None and not user.is_authenticated():
+            user = None
+        audit.begin(user)
+
+    def process_response(self, request, response):
+        audit.flush()
+        return response
@@ -0,0 +1,163 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'RenderJob'
+        db.create_table('invoicer_renderjob', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('invoice', self.gf('django.db.models.fields.related.ForeignKey')(related_name='render_jobs', to=orm['invoicer.Invoice'])),
+            ('status', self.gf('django.db.models.fields.CharField')(default='pending', max_length=10, db_index=True)),
+            ('created', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('started', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('finished', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('attempts', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('error', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal('invoicer', ['RenderJob'])
+
+        # Adding model 'InvoiceArtifact'
+        db.create_table('invoicer_invoiceartifact', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('invoice', self.gf('django.db.models.fields.related.OneToOneField')(related_name='artifact', unique=True, to=orm['invoicer.Invoice'])),
+            ('html', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('pdf', self.gf('django.db.models.fields.files.FileField')(max_length=100, blank=True)),
+            ('rendered', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('stale', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal('invoicer', ['InvoiceArtifact'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'RenderJob'
+        db.delete_table('invoicer_renderjob')
+
+        # Deleting model 'InvoiceArtifact'
+        db.delete_table('invoicer_invoiceartifact')
+
+
+    models = {
+        'invoicer.client': {
+            'Meta': {'object_name': 'Client'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '60'}),
+            'contact_person': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '80', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'phone_number': ('django.contrib.localflavor.us.models.PhoneNumberField', [], {'max_length': '20', 'blank': 'True'}),
+            'project': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2'}),
+            'zip_code': ('django.db.models.fields.CharField', [], {'max_length': '10'})
+        },
+        'invoicer.company': {
+            'Meta': {'object_name': 'Company'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'billing_email': ('django.db.models.fields.EmailField', [], {'max_length': '80', 'blank': 'True'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '60'}),
+            'contact_person': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '80', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'numbering_prefix': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '10'}),
+            'phone_number': ('django.contrib.localflavor.us.models.PhoneNumberField', [], {'max_length': '20', 'blank': 'True'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2'}),
+            'tax_rate': ('django.db.models.fields.DecimalField', [], {'max_digits': '4', 'decimal_places': '2'}),
+            'website': ('django.db.models.fields.URLField', [], {'max_length': '100', 'blank': 'True'}),
+            'zip_code': ('django.db.models.fields.CharField', [], {'max_length': '10'})
+        },
+        'invoicer.invoice': {
+            'Meta': {'object_name': 'Invoice'},
+            'client': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoices'", 'to': "orm['invoicer.Client']"}),
+            'company': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoices'", 'to': "orm['invoicer.Company']"}),
+            'due_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today'}),
+            'invoice_number': ('django.db.models.fields.CharField', [], {'max_length': '20', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            'status_notes': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'terms': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['invoicer.Terms']"}),
+            'version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        'invoicer.invoiceartifact': {
+            'Meta': {'object_name': 'InvoiceArtifact'},
+            'html': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'artifact'", 'unique': 'True', 'to': "orm['invoicer.Invoice']"}),
+            'pdf': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'blank': 'True'}),
+            'rendered': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'stale': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'invoicer.invoicesnapshot': {
+            'Meta': {'object_name': 'InvoiceSnapshot'},
+            'archived': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'client': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoice_snapshots'", 'to': "orm['invoicer.Client']"}),
+            'company': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoice_snapshots'", 'to': "orm['invoicer.Company']"}),
+            'data': ('django.db.models.fields.TextField', [], {}),
+            'html': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice_date': ('django.db.models.fields.DateField', [], {}),
+            'invoice_number': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '20'}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            'total': ('django.db.models.fields.DecimalField', [], {'max_digits': '12', 'decimal_places': '2'})
+        },
+        'invoicer.item': {
+            'Meta': {'object_name': 'Item'},
+            'cost': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '7', 'decimal_places': '2', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'price': ('django.db.models.fields.DecimalField', [], {'max_digits': '7', 'decimal_places': '2'}),
+            'taxable': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'invoicer.lineitem': {
+            'Meta': {'object_name': 'LineItem'},
+            'cost': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '7', 'decimal_places': '2', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'line_items'", 'to': "orm['invoicer.Invoice']"}),
+            'item': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['invoicer.Item']", 'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'price': ('django.db.models.fields.DecimalField', [], {'max_digits': '7', 'decimal_places': '2'}),
+            'quantity': ('django.db.models.fields.DecimalField', [], {'max_digits': '7', 'decimal_places': '2'}),
+            'taxable': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        'invoicer.renderjob': {
+            'Meta': {'object_name': 'RenderJob'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'render_jobs'", 'to': "orm['invoicer.Invoice']"}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'pending'", 'max_length': '10', 'db_index': 'True'})
+        },
+        'invoicer.stylesheet': {
+            'Meta': {'object_name': 'Stylesheet'},
+            'company': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'stylesheets'", 'to': "orm['invoicer.Company']"}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'feedback_text': ('django.db.models.fields.TextField', [], {'max_length': '256', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'introduction_text': ('django.db.models.fields.TextField', [], {'max_length': '256', 'blank': 'True'}),
+            'misc_text': ('django.db.models.fields.TextField', [], {'max_length': '256', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'stylesheet': ('django.db.models.fields.files.FileField', [], {'max_length': '100'}),
+            'thank_you_text': ('django.db.models.fields.TextField', [], {'max_length': '256', 'blank': 'True'})
+        },
+        'invoicer.terms': {
+            'Meta': {'object_name': 'Terms'},
+            'description': ('django.db.models.fields.TextField', [], {'max_length': '256'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        }
+    }
+
+    complete_apps = ['invoicer']
@@ -1,14 +1,89 @@
+import base64
+import json
 import os
-from datetime import date
+import zlib
+from datetime import date, datetime
 from decimal import Decimal
 
 from django.conf import settings
 from django.contrib.localflavor.us.models import PhoneNumberField, USStateField
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.template.defaultfilters import slugify
 
-__all__ = ['Client', 'Company', 'Terms', 'LineItem', 'InvoiceManager',
-            'Invoice', 'Stylesheet', 'Item']
+from invoicer import audit, cache, currency, jobs
+from invoicer.currency import DEFAULT_CURRENCY, REPORTING_CURRENCY, receipts_by_client
+from invoicer.tenancy import NO_COMPANY, get_active_company
+
+__all__ = ['Client', 'Company', 'Terms', 'LineItem', 'CompanyScopedManager', 'InvoiceManager', 'LineItemManager',
+            'Invoice', 'Stylesheet', 'Item', 'VersionedQuerySet', 'VersionedManager',
+            'InvoiceSnapshot', 'RenderJob', 'InvoiceArtifact', 'ChangeEvent', 'ExchangeRate']
+
+class VersionedQuerySet(models.query.QuerySet):
+    """
+    QuerySet for models with a ``version`` column. Writes made through it
+    only succeed if the row is still in the queryset and still has the
+    version the caller last saw, so concurrent editors can't silently
+    overwrite each other and callers can't reach rows outside their scope.
+    """
+    def update_if_current(self, pk, version, **values):
+        """
+        Updates the row and bumps its version in a single conditional UPDATE.
+        Returns ``True`` if the row was still at ``version``.
+        """
+        values["version"] = models.F("version") + 1
+        return self.filter(pk=pk, version=version).update(**values) > 0
+
+    def delete_if_current(self, pk, version):
+        """
+        Deletes the row only if it is still at ``version``. Returns ``True``
+        if a row was deleted. Meant for models nothing else points at, as it
+        skips Django's cascading delete collector.
+        """
+        if not self.filter(pk=pk).exists():
+            return False
+        using = self._db or router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s = %%s AND %s = %%s" % (
+            qn(opts.db_table), qn(opts.pk.column), qn("version")), [pk, version])
+        transaction.commit_unless_managed(using=using)
+        return cursor.rowcount > 0
+
+class VersionedManager(models.Manager):
+    def get_query_set(self):
+        return VersionedQuerySet(self.model, using=self._db)
+
+    def update_if_current(self, pk, version, **values):
+        return self.get_query_set().update_if_current(pk, version, **values)
+
+    def delete_if_current(self, pk, version):
+        return self.get_query_set().delete_if_current(pk, version)
+
+class CompanyScopedManager(models.Manager):
+    """
+    Restricts querysets to the company activated for the current request by
+    ``invoicer.middleware.ActiveCompanyMiddleware``. Without an active
+    company nothing is filtered; if one was required but couldn't be
+    resolved, querysets are empty.
+    """
+    company_field = "company"
+
+    def get_query_set(self):
+        qs = super(CompanyScopedManager, self).get_query_set()
+        company_id = get_active_company()
+        if company_id is NO_COMPANY:
+            return qs.none()
+        if company_id is not None:
+            qs = qs.filter(**{"%s__id" % self.company_field: company_id})
+        return qs
+
+class InvoiceManager(CompanyScopedManager, VersionedManager):
+    pass
+
+class LineItemManager(CompanyScopedManager, VersionedManager):
+    company_field = "invoice__company"
 
 class Entity(models.Model):
     name = models.CharField(max_length=128)
@@ -36,18 +111,19 @@ class Client(Entity):
     def get_absolute_url(self):
         return ('invoicer:client', (), {'id':self.id})
     
-    def receipts_to_date(self):
-        items = LineItem.objects.filter(invoice__client=self).only("price", "quantity", "taxable", "invoice__company__tax_rate").select_related("invoice__company")
-        total = 0
-        for item in items:
-            total += item.total()
-        return total
+    def receipts_to_date(self, currency=REPORTING_CURRENCY):
+        """
+        Everything billed to the client, converted into ``currency`` at the
+        rates of each invoice's date.
+        """
+        return receipts_by_client([self.pk], currency)[self.pk]
 
 class Company(Entity):
     website = models.URLField(max_length=100, blank=True)
     numbering_prefix = models.CharField(max_length=10, unique=True)
     billing_email = models.EmailField(max_length=80, blank=True)
     tax_rate = models.DecimalField(max_digits=4, decimal_places=2)
+    currency = models.CharField(max_length=3, default=DEFAULT_CURRENCY)
     
     class Meta:
         verbose_name_plural = "Companies"
@@ -83,14 +159,53 @@ class AbstractItem(models.Model):
     def __unicode__(self):
         return unicode(self.name)
         
+# Lines are spaced this far apart so one can be moved between two others
+# by writing only its own position.
+POSITION_GAP = 1024
+
 class LineItem(AbstractItem):
     item = models.ForeignKey("Item", blank=True, null=True)
     quantity = models.DecimalField(max_digits=7, decimal_places=2)
     invoice = models.ForeignKey("Invoice", related_name="line_items", editable=False)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    position = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = VersionedManager()
+    manager = LineItemManager()
 
     class Meta:
         verbose_name = "Line Item"
         verbose_name_plural = "Line Items"
+        ordering = ("position", "id")
+
+    @classmethod
+    def renumber(cls, invoice_id):
+        """
+        Spreads an invoice's lines out to ``POSITION_GAP`` apart again.
+        """
+        lines = cls.objects.filter(invoice=invoice_id).values_list("id", flat=True)
+        for i, pk in enumerate(list(lines)):
+            cls.objects.filter(pk=pk).update(position=(i + 1) * POSITION_GAP)
+
+    def move_after(self, after=None):
+        """
+        Moves the line directly below ``after``, or to the top if ``after`` is
+        ``None``, by placing it halfway between its new neighbours. Only this
+        row is written unless the gap has run out and the lines are renumbered.
+        """
+        siblings = LineItem.objects.filter(invoice=self.invoice_id).exclude(pk=self.pk)
+        while True:
+            low = after.position if after is not None else 0
+            following = siblings.filter(position__gt=low).order_by("position")
+            following = list(following.values_list("position", flat=True)[:1])
+            high = following[0] if following else low + 2 * POSITION_GAP
+            if high - low > 1:
+                break
+            LineItem.renumber(self.invoice_id)
+            if after is not None:
+                after = LineItem.objects.get(pk=after.pk)
+        self.position = (low + high) // 2
+        LineItem.objects.filter(pk=self.pk).update(position=self.position)
 
     def ext_price(self):
         ext_price = self.price * self.quantity
@@ -109,14 +224,17 @@ class LineItem(AbstractItem):
             self.cost = self.item.cost
             self.price = self.item.price
             self.taxable = self.item.taxable
+        if not self.position:
+            lines = LineItem.objects.filter(invoice=self.invoice_id)
+            last = lines.aggregate(last=models.Max("position"))["last"]
+            self.position = (last or 0) + POSITION_GAP
+        self.version += 1
         super(LineItem, self).save(*args, **kwargs)
 
-class InvoiceManager(models.Manager):
-    def get_query_set(self):
-        return super(InvoiceManager, self).get_query_set().none()
-
+# Lookups through ``Invoice.manager`` lead with the company, so the table
+# has composite (company, ...) indexes; see migration 0008.
 class Invoice(models.Model):
-    objects = models.Manager()
+    objects = VersionedManager()
     manager = InvoiceManager()
     STATUS_CHOICES = (
         ("unsent", "Unsent"),
@@ -133,6 +251,9 @@ class Invoice(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES)
     status_notes = models.CharField(max_length=128, blank=True)
     terms = models.ForeignKey(Terms)
+    currency = models.CharField(max_length=3, blank=True,
+        help_text="Leave blank to bill in the company's currency.")
+    version = models.PositiveIntegerField(default=0, editable=False)
     
     @models.permalink
     def get_absolute_url(self):
@@ -144,6 +265,9 @@ class Invoice(models.Model):
     def get_invoice_number(self):
         return "%s%05d" %(self.company.numbering_prefix, self.id,)
 
+    def currency_symbol(self):
+        return currency.symbol(self.currency)
+
     def taxable_amount(self):
         taxable = 0
         for line in self.line_items.all():
@@ -167,11 +291,34 @@ class Invoice(models.Model):
             total += line.total()
         return total
 
-    def save(self, force_insert=False, force_update=False):
-        super(Invoice, self).save(force_insert, force_update)
+    def totals(self):
+        """
+        The subtotal, tax and total from a single query over the invoice's
+        lines, rounded the same way as ``subtotal``, ``tax`` and ``total``.
+        """
+        cent = Decimal('.01')
+        multiplier = self.company.tax_multiplier()
+        subtotal = taxable = total = Decimal(0)
+        for price, quantity, is_taxable in self.line_items.values_list("price", "quantity", "taxable"):
+            ext_price = (price * quantity).quantize(cent)
+            subtotal += ext_price
+            if is_taxable:
+                taxable += ext_price
+                total += (ext_price * multiplier).quantize(cent)
+            else:
+                total += ext_price
+        tax = (taxable * self.company.tax_rate/100).quantize(cent)
+        return {"subtotal": subtotal, "tax": tax, "total": total}
+
+    def save(self, *args, **kwargs):
+        if not self.currency:
+            self.currency = self.company.currency
+        self.version += 1
+        super(Invoice, self).save(*args, **kwargs)
         if not self.invoice_number:
             self.invoice_number = self.get_invoice_number()
-            self.save()
+            # The row exists now, so this is an update on the same database.
+            self.save(using=kwargs.get("using"))
 
 
 def stylesheet_upload(instance, filename):
@@ -193,3 +340,183 @@ class Stylesheet(models.Model):
     
 class Item(AbstractItem):
     pass
+
+def compress(text):
+    return base64.b64encode(zlib.compress(text.encode("utf-8"), 9))
+
+def decompress(data):
+    return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+
+class InvoiceSnapshot(models.Model):
+    """
+    A frozen copy of a paid invoice: its header, lines and totals as JSON plus
+    the rendered page, both zlib compressed. Snapshots outlive the invoice
+    rows they were taken from and are never modified once written.
+    """
+    invoice_number = models.CharField(max_length=20, unique=True)
+    company = models.ForeignKey(Company, related_name="invoice_snapshots")
+    client = models.ForeignKey(Client, related_name="invoice_snapshots")
+    invoice_date = models.DateField()
+    status = models.CharField(max_length=10, choices=Invoice.STATUS_CHOICES)
+    total = models.DecimalField(max_digits=12, decimal_places=2)
+    archived = models.DateTimeField(default=datetime.now)
+    data = models.TextField(editable=False)
+    html = models.TextField(editable=False)
+
+    objects = models.Manager()
+    manager = CompanyScopedManager()
+
+    class Meta:
+        verbose_name = "Invoice Snapshot"
+        verbose_name_plural = "Invoice Snapshots"
+
+    def __unicode__(self):
+        return self.invoice_number
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('invoicer:invoice', (), {'id':self.invoice_number})
+
+    def get_data(self):
+        return json.loads(decompress(self.data))
+
+    def set_data(self, data):
+        self.data = compress(json.dumps(data, separators=(',',':')))
+
+    def get_html(self):
+        return decompress(self.html)
+
+    def set_html(self, html):
+        self.html = compress(html)
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Invoice snapshots can't be changed once archived.")
+        super(InvoiceSnapshot, self).save(*args, **kwargs)
+
+class RenderJob(models.Model):
+    """
+    A request to pre-render an invoice, picked up by the ``render_invoices``
+    worker. At most one job per invoice is pending at a time.
+    """
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+    invoice = models.ForeignKey(Invoice, related_name="render_jobs")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending", db_index=True)
+    created = models.DateTimeField(default=datetime.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = "Render Job"
+        verbose_name_plural = "Render Jobs"
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.invoice_id, self.status)
+
+def artifact_upload(instance, filename):
+    upload_dir = getattr(settings, "INVOICER_UPLOAD_DIR", "invoicer").strip("/")
+    return os.path.join(upload_dir, "invoices", unicode(instance.invoice.company_id), filename)
+
+class InvoiceArtifact(models.Model):
+    """
+    The latest pre-rendered page (and PDF, if a renderer is configured) of an
+    invoice. ``stale`` is set as soon as the invoice changes and cleared once
+    a worker has caught up.
+    """
+    invoice = models.OneToOneField(Invoice, related_name="artifact")
+    html = models.TextField(blank=True)
+    pdf = models.FileField(upload_to=artifact_upload, blank=True)
+    rendered = models.DateTimeField(default=datetime.now)
+    stale = models.BooleanField(default=False)
+
+    class Meta:
+        verbose_name = "Invoice Artifact"
+        verbose_name_plural = "Invoice Artifacts"
+
+    def __unicode__(self):
+        return unicode(self.invoice_id)
+
+class ChangeEvent(models.Model):
+    """
+    An append-only record of a change to an invoice or line item, for
+    downstream systems to tail. ``changes`` holds JSON mapping each changed
+    field to its ``[old, new]`` values. The invoice and company are plain ids
+    so events outlive the rows they describe.
+    """
+    ACTION_CHOICES = (
+        ("create", "Created"),
+        ("update", "Updated"),
+        ("delete", "Deleted"),
+    )
+    created = models.DateTimeField(default=datetime.now)
+    user = models.ForeignKey("auth.User", null=True, blank=True, on_delete=models.SET_NULL,
+        related_name="invoicer_changes")
+    username = models.CharField(max_length=30, blank=True)
+    model = models.CharField(max_length=32)
+    object_id = models.PositiveIntegerField()
+    invoice_id = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    company_id = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    changes = models.TextField()
+
+    class Meta:
+        verbose_name = "Change Event"
+        verbose_name_plural = "Change Events"
+        ordering = ("id",)
+
+    def __unicode__(self):
+        return u"%s %s %s" % (self.action, self.model, self.object_id)
+
+    def get_changes(self):
+        return json.loads(self.changes)
+
+    def set_changes(self, changes):
+        self.changes = json.dumps(changes, separators=(',',':'))
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "created": self.created.isoformat(),
+            "user": self.username,
+            "model": self.model,
+            "object_id": self.object_id,
+            "invoice_id": self.invoice_id,
+            "company_id": self.company_id,
+            "action": self.action,
+            "changes": self.get_changes(),
+        }
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Change events can't be modified.")
+        super(ChangeEvent, self).save(*args, **kwargs)
+
+class ExchangeRate(models.Model):
+    """
+    Units of ``currency`` per unit of ``INVOICER_DEFAULT_CURRENCY`` on a
+    given day. Loaded with the ``load_exchange_rates`` command.
+    """
+    date = models.DateField()
+    currency = models.CharField(max_length=3)
+    rate = models.DecimalField(max_digits=18, decimal_places=8)
+
+    class Meta:
+        verbose_name = "Exchange Rate"
+        verbose_name_plural = "Exchange Rates"
+        unique_together = (("date", "currency"),)
+        ordering = ("-date", "currency")
+
+    def __unicode__(self):
+        return u"%s %s %s" % (self.date, self.currency, self.rate)
+
+cache.register((Client, Company, Terms), Stylesheet)
+jobs.register(Invoice, LineItem, (Client, Company, Terms), Stylesheet)
+audit.register(Invoice, LineItem)
+currency.register(ExchangeRate)
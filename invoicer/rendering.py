@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.db.models import Q
+from django.template.loader import render_to_string
+
+from invoicer.cache import FRAGMENT_TIMEOUT, fragment_versions, get_company_stylesheet
+from invoicer.forms import InvoiceForm
+
+LINES_PER_PAGE = getattr(settings, "INVOICER_LINES_PER_PAGE", 100)
+
+def invoice_lines(invoice, after=None, limit=LINES_PER_PAGE):
+    """
+    Returns up to ``limit`` of the invoice's lines, or all of them if
+    ``limit`` is ``None``, and whether more lines follow. With ``after``, a
+    ``(position, id)`` pair, only lines ordered after that line are
+    included. Paging from the last loaded line rather than an offset means
+    lines deleted or moved in the meantime can't make a range skip or repeat
+    rows.
+    """
+    lines = invoice.line_items.order_by("position", "id")
+    if after is not None:
+        position, pk = after
+        lines = lines.filter(Q(position__gt=position) | Q(position=position, id__gt=pk))
+    if limit is None:
+        lines, more = list(lines), False
+    else:
+        lines = list(lines[:limit + 1])
+        more = len(lines) > limit
+        lines = lines[:limit]
+    for line in lines:
+        line.invoice = invoice
+    return lines, more
+
+def render_lines(lines):
+    return render_to_string('line_rows.html', {"lines":lines})
+
+def invoice_context(invoice, all_lines=False, **extra):
+    """
+    Builds the context ``invoice.html`` is rendered with. Only the first
+    ``LINES_PER_PAGE`` lines are included, unless ``all_lines`` is set for
+    output that can't load the rest itself, such as archived pages, stored
+    artifacts and downloads.
+    """
+    stylesheet = get_company_stylesheet(invoice.company)
+    limit = None if all_lines else LINES_PER_PAGE
+    lines, more_lines = invoice_lines(invoice, limit=limit)
+    context = {
+        'invoice':invoice,
+        "stylesheet":stylesheet,
+        "invoice_form":InvoiceForm(),
+        "lines":lines,
+        "more_lines":more_lines,
+        "totals":invoice.totals(),
+        "fragment_timeout":FRAGMENT_TIMEOUT,
+        "versions":fragment_versions(invoice, stylesheet),
+    }
+    context.update(extra)
+    return context
+
+def render_invoice(invoice, all_lines=False, **extra):
+    """
+    Renders an invoice's page outside of a request, e.g. for archiving.
+    """
+    context = invoice_context(invoice, all_lines, MEDIA_URL=settings.MEDIA_URL, **extra)
+    return render_to_string('invoice.html', context)
@@ -0,0 +1,24 @@
+from invoicer.tenancy import COMPANY_DATABASES, get_active_company, get_database
+
+class CompanyRouter(object):
+    """
+    Routes invoicer's models to the database ``INVOICER_COMPANY_DATABASES``
+    maps the active company to, so large tenants can live on their own
+    database. Each of those databases holds the app's full schema; companies
+    without an entry stay on the default database.
+    """
+    def database(self, model):
+        if model._meta.app_label != "invoicer":
+            return None
+        return get_database() or COMPANY_DATABASES.get(get_active_company())
+
+    def db_for_read(self, model, **hints):
+        return self.database(model)
+
+    def db_for_write(self, model, **hints):
+        return self.database(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == "invoicer" and obj2._meta.app_label == "invoicer":
+            return obj1._state.db == obj2._state.db
+        return None
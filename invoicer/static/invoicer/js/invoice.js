@@ -0,0 +1,245 @@
+// Editing behaviour for invoice.html. The page defines an INVOICER object
+// holding the urls this file talks to before loading it.
+$(function(){
+    var indicator = 'Saving...',
+        loading = false,
+        merge_cells = function (holder, cells) {
+            //refresh the cells another editor changed, leaving the rest alone
+            for (name in cells) {
+                var cell = holder.is("tr") ? holder.find("[id$='-" + name + "']") : jQuery("#" + name),
+                    node;
+                if (!cell.length) {
+                    continue;
+                }
+                cell.attr("data-value", cells[name]);
+                if (name == "name") {
+                    //the name cell also holds the description div
+                    node = cell[0].firstChild;
+                    if (node && node.nodeType == 3 && node.nodeValue != cells[name]) {
+                        node.nodeValue = cells[name];
+                    }
+                }
+                else if (cell.text() != cells[name]) {
+                    cell.text(cells[name]);
+                }
+            }
+            if (holder.is("tr")) {
+                var price = parseFloat(holder.find("td.price").text()),
+                    quantity = parseFloat(holder.find("td.quantity").text());
+                holder.find("td.ext_price").text((price * quantity).toFixed(2));
+            }
+        },
+        update_totals = function (totals) {
+            //totals come from the server, as not every line may be loaded
+            if (!totals) {
+                return;
+            }
+            jQuery(".total-value.subtotal").text(totals.subtotal);
+            jQuery(".total-value.tax").text(totals.tax);
+            jQuery(".total-value.total").text(totals.total);
+        },
+        ajaxEdit = function(value, settings){
+            var td = jQuery(this),
+                element_id = td.attr("id"),
+                row = td.closest("tr.item-row"),
+                holder = row.length ? row : jQuery("#meta"),
+                data = {
+                    element_id: element_id,
+                    field: element_id.split("-").pop(),
+                    value: value,
+                    //the stored value, as this.revert is the cell's HTML
+                    original: td.attr("data-value") || "",
+                    version: holder.attr("data-version")
+                };
+            if (row.length) {
+                data["line"] = row.attr("name");
+            }
+            var url = INVOICER.edit_url;
+
+            //submit just the edited cell along with the version we saw
+            var val = jQuery.ajax({
+                data: data,
+                url: url,
+                type: "POST",
+                success: function(data, status){
+                    if (data.status == "success") {
+                        if (data.value == "DELETE"){
+                            td.parent("tr.item-row").remove();
+                            update_totals(data.totals);
+                            return;
+                        }
+                        holder.attr("data-version", data.version);
+                        td.removeClass("error").removeClass("conflict").text(data.value).attr("data-value", data.value);
+                        if (data.cells) {
+                            merge_cells(holder, data.cells);
+                        }
+                        update_totals(data.totals);
+                    }
+                    else if (data.status == "conflict") {
+                        //someone else changed this row; show their values
+                        holder.attr("data-version", data.version);
+                        merge_cells(holder, data.cells);
+                        update_totals(data.totals);
+                        td.addClass("conflict");
+                    }
+                    else{
+                        td.addClass("error").text(value);
+                        for (key in data.errors){
+                            var element = jQuery("#" + key);
+                            // do something with the error message here.
+                        }
+                    }
+                },
+                error: function(data, status){
+                    console.log("Ajax error!");
+                },
+                dataType: "json"
+            });
+            return indicator;
+        },
+        bind_editing = function (scope) {
+            scope.find(".edit:not(.nosave):not(.area):not(.taxable)").editable(ajaxEdit, {
+                indicator:indicator,
+                placeholder:''
+            });
+            scope.find(".edit.taxable").editable(ajaxEdit, {
+                type:"select",
+                data:{'Y':'Y', 'N':'N'},
+                onblur:"submit"
+            });
+            scope.find("td.recalc").change(function(){
+                var element = jQuery(this),
+                    price, quantity, ext_price;
+                if (element.hasClass("price")){
+                    price = parseFloat(element.find("input").attr("value")).toFixed(2);
+                }
+                else {
+                    price = parseFloat(element.siblings("td.price").text()).toFixed(2);
+                }
+                if (element.hasClass("quantity")){
+                    quantity = parseFloat(element.find("input").attr("value")).toFixed(2);
+                }
+                else {
+                    quantity = parseFloat(element.siblings("td.quantity").text()).toFixed(2);
+                }
+                ext_price = price * quantity;
+                element.siblings("td.ext_price").text(ext_price.toFixed(2));
+            });
+        },
+        bind_rows = function (rows) {
+            bind_editing(rows);
+            rows.tooltip({
+                tip: "#row-tools",
+                delay: 750,
+                predelay: 250,
+                position: "top right",
+                effect: "fade",
+                offset: [15, -25],
+                api: true,
+                lazy: true,
+                onBeforeShow: function(pos) {
+                    var row = this.getTrigger().closest("tr.item-row");
+                    jQuery("#trigger-row-id").attr("value", row.attr("id"));
+                }
+            });
+        },
+        load_more = function () {
+            //fetch the lines following the last one on the page rather than
+            //rendering them all up front
+            var body = jQuery("#line-items"),
+                last = body.find("tr.item-row:last"),
+                data = {};
+            if (loading || !body.attr("data-more")) {
+                return;
+            }
+            if (last.length) {
+                data = {position: last.attr("data-position"), id: last.attr("name")};
+            }
+            loading = true;
+            jQuery.ajax({
+                url: INVOICER.lines_url,
+                data: data,
+                dataType: "json",
+                success: function (data) {
+                    var rows = jQuery(data.html).filter("tr.item-row");
+                    body.append(rows);
+                    bind_rows(rows);
+                    body.attr("data-more", data.more ? "1" : "");
+                },
+                complete: function () {
+                    //let the next scroll retry after a failed request
+                    loading = false;
+                }
+            });
+        };
+
+    bind_editing(jQuery("#meta"));
+    bind_rows(jQuery("#line-items tr.item-row"));
+
+    jQuery(".edit.nosave:not(.area)").editable(function(value, settings){return value;}, {placeholder:''});
+    jQuery(".edit.area.nosave").editable(function(value, settings){return value;}, {
+        type:'textarea',
+        rows:3,
+        placeholder:'',
+        submit:'Accept Changes',
+        cancel:'Cancel'
+    });
+
+    jQuery("#row-tools a.delete-button").overlay({
+        target: "#confirm-delete",
+        expose: {
+            color: '#333',
+            loadSpeed: 200,
+            opacity: 0.9
+        }
+    });
+
+    jQuery("#row-tools a.add-button").overlay({
+        target: "#add-modal",
+        expose: {
+            color: '#333',
+            loadSpeed: 200,
+            opacity: 0.9
+        },
+        onBeforeLoad: function () {
+            var container = this.getContent().find("table.container");
+            container.load(INVOICER.add_line_url);
+        }
+    });
+
+    jQuery("#confirm-delete button.confirm").click(function () {
+        var id = jQuery("#trigger-row-id").attr("value"),
+            row = jQuery("#" + id),
+            td = row.find("td.delete"),
+            checkbox = row.find("td.delete input:checkbox");
+        checkbox.attr("checked", true);
+        ajaxEdit.apply(td, ["DELETE"]);
+    });
+
+    jQuery("#line-items").sortable({
+        items: "tr.item-row",
+        axis: "y",
+        update: function (event, ui) {
+            //only the moved line's position changes on the server
+            var row = ui.item,
+                previous = row.prev("tr.item-row");
+            jQuery.post(INVOICER.move_url, {
+                line: row.attr("name"),
+                after: previous.length ? previous.attr("name") : ""
+            }, function (data) {
+                //keep the position current, as the next range of lines is
+                //loaded from the last row's position
+                if (data.status == "success") {
+                    row.attr("data-position", data.position);
+                }
+            }, "json");
+        }
+    });
+
+    jQuery(window).scroll(function () {
+        var win = jQuery(window);
+        if (win.scrollTop() + win.height() > jQuery(document).height() - 400) {
+            load_more();
+        }
+    });
+});
@@ -0,0 +1,76 @@
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.importlib import import_module
+
+# Stands in for "no company could be resolved" when one is required, so
+# scoped querysets come back empty instead of unscoped.
+NO_COMPANY = object()
+
+REQUIRE_COMPANY = getattr(settings, "INVOICER_REQUIRE_COMPANY", False)
+COMPANY_RESOLVER = getattr(settings, "INVOICER_COMPANY_RESOLVER", "invoicer.tenancy.session_company")
+COMPANY_DATABASES = getattr(settings, "INVOICER_COMPANY_DATABASES", {})
+
+_active = threading.local()
+
+def activate(company_id):
+    if company_id is not None and company_id is not NO_COMPANY:
+        company_id = int(company_id)
+    _active.company = company_id
+
+def deactivate():
+    _active.company = None
+
+def clean_company_id(value):
+    """
+    Turns a resolver's result into a company id, or ``None`` if it isn't
+    one, so a malformed session value counts as no company at all.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def use_database(alias):
+    """
+    Sends every invoicer query on this thread to ``alias`` regardless of
+    the active company, or stops doing so when ``alias`` is ``None``. Used
+    by the management commands to work through each company database.
+    """
+    _active.database = alias
+
+def get_database():
+    return getattr(_active, "database", None)
+
+def company_databases():
+    """
+    The default database followed by each database in
+    ``INVOICER_COMPANY_DATABASES``.
+    """
+    aliases = [DEFAULT_DB_ALIAS]
+    for alias in sorted(set(COMPANY_DATABASES.values())):
+        if alias not in aliases:
+            aliases.append(alias)
+    return aliases
+
+def get_active_company():
+    """
+    The id of the company the current thread is working for, ``None`` if
+    there is none, or ``NO_COMPANY`` if one was required but not found.
+    """
+    return getattr(_active, "company", None)
+
+def session_company(request):
+    """
+    The default ``INVOICER_COMPANY_RESOLVER``: the company id stored in the
+    session under ``invoicer_company``.
+    """
+    session = getattr(request, "session", None)
+    if session is None:
+        return None
+    return session.get("invoicer_company")
+
+def get_resolver():
+    module, attr = COMPANY_RESOLVER.rsplit(".", 1)
+    return getattr(import_module(module), attr)
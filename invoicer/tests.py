@@ -0,0 +1,651 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.conf.urls import include, patterns
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseNotFound
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from invoicer import admin, archive, audit, cache, currency, jobs, middleware, rendering, routers, tenancy
+from invoicer.models import (ChangeEvent, Client, Company, Invoice, InvoiceArtifact, InvoiceSnapshot,
+    LineItem, RenderJob, Stylesheet, Terms, compress, decompress)
+from invoicer.management.commands import profile_imports
+from invoicer.rendering import invoice_lines
+
+def failing_renderer(html, invoice):
+    raise RuntimeError("No PDF today")
+
+class InvoiceTestCase(TestCase):
+    def setUp(self):
+        # Primary keys are reused between tests, so don't carry cached rows over.
+        cache.local_cache.clear()
+        User.objects.create_user("editor", "editor@example.com", "secret")
+        self.client.login(username="editor", password="secret")
+        self.company = Company.objects.create(name="Acme", numbering_prefix="AC",
+            tax_rate=Decimal("10.00"))
+        self.customer = Client.objects.create(name="Customer")
+        self.terms = Terms.objects.create(name="Net 30", description="Due in 30 days.")
+        self.invoice = self.create_invoice()
+        self.line = self.create_line(self.invoice)
+
+    def create_invoice(self, **kwargs):
+        values = {"company": self.company, "client": self.customer, "terms": self.terms, "status": "unsent"}
+        values.update(kwargs)
+        return Invoice.objects.create(**values)
+
+    def create_line(self, invoice):
+        return LineItem.objects.create(invoice=invoice, name="Widget",
+            price=Decimal("10.00"), quantity=Decimal("2.00"), taxable=False)
+
+    def reload(self, obj):
+        return type(obj).objects.get(pk=obj.pk)
+
+class EditInvoiceTest(InvoiceTestCase):
+    def edit(self, invoice=None, **data):
+        invoice = invoice or self.invoice
+        response = self.client.post(reverse("invoicer:edit_invoice", kwargs={"id": invoice.invoice_number}),
+            data, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def edit_price(self, value, original="10.00", version=None, line=None):
+        line = line or self.line
+        return self.edit(field="price", value=value, original=original,
+            version=line.version if version is None else version, line=line.pk)
+
+    def test_edit_at_current_version(self):
+        data = self.edit_price("12.50")
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(data["version"], self.line.version + 1)
+        self.assertEqual(data["totals"]["total"], "25.00")
+        line = self.reload(self.line)
+        self.assertEqual(line.price, Decimal("12.50"))
+        self.assertEqual(line.version, self.line.version + 1)
+
+    def test_stale_version_merges_other_cell(self):
+        LineItem.objects.update_if_current(self.line.pk, self.line.version, quantity=Decimal("5.00"))
+        data = self.edit_price("12.50")
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(data["version"], self.line.version + 2)
+        self.assertEqual(data["cells"]["quantity"], "5.00")
+        line = self.reload(self.line)
+        self.assertEqual((line.price, line.quantity), (Decimal("12.50"), Decimal("5.00")))
+
+    def test_stale_version_same_cell_conflicts(self):
+        LineItem.objects.update_if_current(self.line.pk, self.line.version, price=Decimal("11.00"))
+        data = self.edit_price("12.50")
+        self.assertEqual(data["status"], "conflict")
+        self.assertEqual(data["version"], self.line.version + 1)
+        self.assertEqual(data["cells"]["price"], "11.00")
+        self.assertEqual(self.reload(self.line).price, Decimal("11.00"))
+
+    def test_line_of_another_invoice_is_not_edited(self):
+        other = self.create_line(self.create_invoice())
+        data = self.edit(field="price", value="99.00", original="10.00",
+            version=other.version, line=other.pk)
+        self.assertEqual(data["status"], "error")
+        self.assertEqual(self.reload(other).price, Decimal("10.00"))
+        self.assertEqual(self.reload(other).version, other.version)
+
+    def test_line_of_another_invoice_is_not_deleted(self):
+        other = self.create_line(self.create_invoice())
+        data = self.edit(field="DELETE", value="DELETE", version=other.version, line=other.pk)
+        self.assertEqual(data["status"], "error")
+        self.assertTrue(LineItem.objects.filter(pk=other.pk).exists())
+
+    def test_delete_at_stale_version_conflicts(self):
+        LineItem.objects.update_if_current(self.line.pk, self.line.version, quantity=Decimal("5.00"))
+        data = self.edit(field="DELETE", value="DELETE", version=self.line.version, line=self.line.pk)
+        self.assertEqual(data["status"], "conflict")
+        self.assertTrue(LineItem.objects.filter(pk=self.line.pk).exists())
+
+    def test_delete_at_current_version(self):
+        data = self.edit(field="DELETE", value="DELETE", version=self.line.version, line=self.line.pk)
+        self.assertEqual(data["status"], "success")
+        self.assertFalse(LineItem.objects.filter(pk=self.line.pk).exists())
+
+    def test_invalid_value(self):
+        data = self.edit_price("lots")
+        self.assertEqual(data["status"], "error")
+        self.assertTrue("price" in data["errors"])
+
+    def test_stale_version_merges_name(self):
+        LineItem.objects.update_if_current(self.line.pk, self.line.version, price=Decimal("11.00"))
+        data = self.edit(field="name", value="Gadget", original="Widget",
+            version=self.line.version, line=self.line.pk)
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(data["cells"]["price"], "11.00")
+        self.assertEqual(self.reload(self.line).name, "Gadget")
+
+    def test_date_edit_merges(self):
+        # The page shows the date as it's posted back, so an edit made
+        # against an older version of the invoice can still be merged.
+        Invoice.objects.update_if_current(self.invoice.pk, self.invoice.version, status="sent")
+        data = self.edit(field="invoice_date", value="2012-01-02",
+            original=self.invoice.invoice_date.isoformat(), version=self.invoice.version)
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(data["value"], "2012-01-02")
+        invoice = self.reload(self.invoice)
+        self.assertEqual((invoice.invoice_date.isoformat(), invoice.status), ("2012-01-02", "sent"))
+
+    def test_bad_line_id(self):
+        response = self.client.post(reverse("invoicer:edit_invoice", kwargs={"id": self.invoice.invoice_number}),
+            {"field": "price", "value": "1.00", "version": "1", "line": "x"},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 400)
+
+    def test_change_event_records_stored_old_value(self):
+        # The old value comes from the row, not from what the client claims.
+        self.edit_price("12.50", original="999.00")
+        event = ChangeEvent.objects.get(model="lineitem", object_id=self.line.pk, action="update")
+        self.assertEqual(event.get_changes(), {"price": ["10.00", "12.50"]})
+        self.assertEqual((event.invoice_id, event.company_id), (self.invoice.pk, self.company.pk))
+
+class SettledEventsTest(TestCase):
+    def create_event(self, age):
+        event = ChangeEvent(model="invoice", object_id=1, action="update",
+            created=datetime.now() - timedelta(seconds=age))
+        event.set_changes({})
+        event.save()
+        return event
+
+    def test_stops_at_first_unsettled_event(self):
+        old = self.create_event(audit.SETTLE_SECONDS + 60)
+        self.create_event(0)
+        self.create_event(audit.SETTLE_SECONDS + 60)
+        events = audit.settled(ChangeEvent.objects.all(), 0, 10)
+        self.assertEqual([event.pk for event in events], [old.pk])
+
+    def test_after_cursor(self):
+        first = self.create_event(audit.SETTLE_SECONDS + 60)
+        second = self.create_event(audit.SETTLE_SECONDS + 60)
+        events = audit.settled(ChangeEvent.objects.all(), first.pk, 10)
+        self.assertEqual([event.pk for event in events], [second.pk])
+
+class InvoiceLinesTest(InvoiceTestCase):
+    def setUp(self):
+        super(InvoiceLinesTest, self).setUp()
+        self.lines = [self.line] + [self.create_line(self.invoice) for i in range(4)]
+
+    def test_pages_from_last_line(self):
+        first, more = invoice_lines(self.invoice, limit=2)
+        self.assertEqual(first, self.lines[:2])
+        self.assertTrue(more)
+        # Deleting a loaded line doesn't shift the next range.
+        self.lines[0].delete()
+        last = first[-1]
+        rest, more = invoice_lines(self.invoice, (last.position, last.pk), limit=2)
+        self.assertEqual(rest, self.lines[2:4])
+        self.assertTrue(more)
+
+    def test_moved_line_is_not_repeated(self):
+        first, more = invoice_lines(self.invoice, limit=2)
+        self.lines[4].move_after(self.lines[0])
+        last = first[-1]
+        rest, more = invoice_lines(self.invoice, (last.position, last.pk), limit=10)
+        self.assertEqual(rest, self.lines[2:4])
+        self.assertFalse(more)
+
+    def test_lines_view(self):
+        last = self.lines[2]
+        response = self.client.get(reverse("invoicer:invoice_lines", kwargs={"id": self.invoice.invoice_number}),
+            {"position": last.position, "id": last.pk})
+        data = json.loads(response.content)
+        self.assertFalse(data["more"])
+        self.assertTrue('id="line-%s"' % self.lines[3].pk in data["html"])
+        self.assertFalse('id="line-%s"' % last.pk in data["html"])
+        # Edits post the stored value back, not the cell's HTML.
+        self.assertTrue('-name" class="item text edit" data-value="Widget"' in data["html"])
+
+    def test_all_lines(self):
+        Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css")
+        per_page, rendering.LINES_PER_PAGE = rendering.LINES_PER_PAGE, 2
+        try:
+            context = rendering.invoice_context(self.invoice)
+            self.assertEqual((context["lines"], context["more_lines"]), (self.lines[:2], True))
+            context = rendering.invoice_context(self.invoice, all_lines=True)
+            self.assertEqual((context["lines"], context["more_lines"]), (self.lines, False))
+        finally:
+            rendering.LINES_PER_PAGE = per_page
+
+class RenderJobTest(InvoiceTestCase):
+    def setUp(self):
+        self.background, jobs.RENDER_IN_BACKGROUND = jobs.RENDER_IN_BACKGROUND, True
+        jobs.register(Invoice, LineItem, (Client, Company, Terms), Stylesheet)
+        super(RenderJobTest, self).setUp()
+        self.stylesheet = Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css")
+        self.artifact = InvoiceArtifact.objects.create(invoice=self.invoice, html="<p>old</p>")
+
+    def tearDown(self):
+        jobs.RENDER_IN_BACKGROUND = self.background
+
+    def stale(self):
+        return self.reload(self.artifact).stale
+
+    def test_client_change_marks_artifact_stale(self):
+        self.customer.address = "1 New Street"
+        self.customer.save()
+        self.assertTrue(self.stale())
+
+    def test_terms_change_marks_artifact_stale(self):
+        self.terms.description = "Due in 60 days."
+        self.terms.save()
+        self.assertTrue(self.stale())
+
+    def test_stylesheet_delete_marks_artifact_stale(self):
+        self.stylesheet.delete()
+        self.assertTrue(self.stale())
+
+    def test_other_client_change_leaves_artifact(self):
+        Client.objects.create(name="Someone else")
+        self.assertFalse(self.stale())
+
+    def test_edit_queues_one_job(self):
+        RenderJob.objects.all().delete()
+        self.line.price = Decimal("12.00")
+        self.line.save()
+        self.create_line(self.invoice)
+        self.assertEqual(RenderJob.objects.filter(invoice=self.invoice, status="pending").count(), 1)
+        self.assertTrue(self.stale())
+
+    def test_claim_is_exclusive(self):
+        job = jobs.claim()
+        self.assertEqual(job.invoice_id, self.invoice.pk)
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, "running")
+        self.assertEqual(jobs.claim(), None)
+
+    def test_run_stores_artifact(self):
+        self.artifact.stale = True
+        self.artifact.save()
+        job = jobs.claim()
+        self.assertTrue(jobs.run(job))
+        artifact = self.reload(self.artifact)
+        self.assertFalse(artifact.stale)
+        self.assertTrue("Widget" in artifact.html)
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, "done")
+        self.assertEqual(jobs.fresh_artifact(self.invoice), artifact)
+
+    def test_change_while_rendering_keeps_artifact_stale(self):
+        job = jobs.claim()
+        self.line.save()
+        self.assertTrue(jobs.run(job))
+        self.assertTrue(self.stale())
+        self.assertEqual(jobs.fresh_artifact(self.invoice), None)
+
+    def test_failing_renderer_keeps_previous_artifact(self):
+        renderer, jobs.PDF_RENDERER = jobs.PDF_RENDERER, "invoicer.tests.failing_renderer"
+        try:
+            job = jobs.claim()
+            self.assertFalse(jobs.run(job))
+        finally:
+            jobs.PDF_RENDERER = renderer
+        job = RenderJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, "failed")
+        self.assertTrue("No PDF today" in job.error)
+        self.assertEqual(self.reload(self.artifact).html, "<p>old</p>")
+
+    def test_requeue_abandoned(self):
+        job = jobs.claim()
+        self.assertEqual(jobs.requeue_abandoned(), 0)
+        RenderJob.objects.filter(pk=job.pk).update(
+            started=datetime.now() - timedelta(seconds=jobs.RENDER_TIMEOUT + 60))
+        self.assertEqual(jobs.requeue_abandoned(), 1)
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, "pending")
+
+class AdminTest(InvoiceTestCase):
+    def setUp(self):
+        super(AdminTest, self).setUp()
+        User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.client.login(username="admin", password="secret")
+
+    def test_invoice_inline_pages(self):
+        self.create_invoice()
+        self.create_invoice()
+        per_page, admin.PaginatedInlineFormSet.per_page = admin.PaginatedInlineFormSet.per_page, 2
+        try:
+            url = reverse("admin:invoicer_client_change", args=(self.customer.pk,))
+            first = self.client.get(url)
+            last = self.client.get(url, {"invoices_page": 2})
+        finally:
+            admin.PaginatedInlineFormSet.per_page = per_page
+        self.assertContains(first, "page 1 of 2 (3 invoices)")
+        self.assertContains(first, "?invoices_page=2")
+        self.assertContains(last, "page 2 of 2 (3 invoices)")
+        self.assertContains(last, "?invoices_page=1")
+        self.assertContains(last, "%s?client=%s" % (
+            reverse("admin:invoicer_invoice_changelist"), self.customer.pk))
+
+    def test_client_filter_lists_most_invoiced(self):
+        other = Client.objects.create(name="Other")
+        Invoice.objects.create(company=self.company, client=other, terms=self.terms, status="unsent")
+        self.create_invoice()
+        factory = RequestFactory()
+        limit, admin.FILTER_LIMIT = admin.FILTER_LIMIT, 1
+        try:
+            top = admin.ClientListFilter(factory.get("/"), {}, Invoice, None)
+            params = {"client": unicode(other.pk)}
+            active = admin.ClientListFilter(factory.get("/", params), params, Invoice, None)
+        finally:
+            admin.FILTER_LIMIT = limit
+        self.assertEqual(top.lookup_choices, [(unicode(self.customer.pk), u"Customer")])
+        # The active choice is listed even outside the top entries.
+        self.assertEqual(active.lookup_choices, [(unicode(self.customer.pk), u"Customer"),
+            (unicode(other.pk), u"Other")])
+
+    def test_invoice_changelist_filters_by_client(self):
+        other = Client.objects.create(name="Other")
+        Invoice.objects.create(company=self.company, client=other, terms=self.terms, status="unsent")
+        response = self.client.get(reverse("admin:invoicer_invoice_changelist"), {"client": self.customer.pk})
+        self.assertEqual([invoice.pk for invoice in response.context["cl"].result_list], [self.invoice.pk])
+
+class ArchiveTest(InvoiceTestCase):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css")
+        self.paid = self.create_invoice(status="paid", invoice_date=date.today() - timedelta(days=100))
+        self.create_line(self.paid)
+
+    def archive(self, **kwargs):
+        return list(archive.archive_invoices(days=90, **kwargs))
+
+    def test_compress_round_trip(self):
+        text = u"Caf\xe9 <b>invoice</b>" * 50
+        self.assertTrue(len(compress(text)) < len(text))
+        self.assertEqual(decompress(compress(text)), text)
+
+    def test_archives_old_paid_invoices(self):
+        results = self.archive()
+        self.assertEqual([(invoice.pk, error) for invoice, snapshot, error in results], [(self.paid.pk, None)])
+        snapshot = InvoiceSnapshot.objects.get(invoice_number=self.paid.invoice_number)
+        data = snapshot.get_data()
+        self.assertEqual(data["totals"], {"subtotal": "20.00", "tax": "0.00", "total": "20.00"})
+        self.assertEqual([data["lines"][0][name] for name in ("name", "price", "quantity")],
+            ["Widget", "10.00", "2.00"])
+        self.assertTrue("Widget" in snapshot.get_html())
+        self.assertTrue(Invoice.objects.filter(pk=self.paid.pk).exists())
+        # Once archived, an invoice isn't picked up again.
+        self.assertEqual(self.archive(), [])
+
+    def test_archived_invoice_is_served_from_snapshot(self):
+        self.archive(prune=True)
+        response = self.client.get(reverse("invoicer:invoice", kwargs={"id": self.paid.invoice_number}))
+        self.assertContains(response, "Widget")
+
+    def test_snapshots_are_read_only(self):
+        self.archive()
+        snapshot = InvoiceSnapshot.objects.get(invoice_number=self.paid.invoice_number)
+        self.assertRaises(ValueError, snapshot.save)
+
+    def test_prune(self):
+        self.archive(prune=True)
+        self.assertFalse(Invoice.objects.filter(pk=self.paid.pk).exists())
+        self.assertFalse(LineItem.objects.filter(invoice=self.paid.pk).exists())
+        self.assertTrue(InvoiceSnapshot.objects.filter(invoice_number=self.paid.invoice_number).exists())
+
+    def test_prune_archived(self):
+        self.archive()
+        self.assertEqual(archive.prune_archived(), 1)
+        self.assertFalse(Invoice.objects.filter(pk=self.paid.pk).exists())
+        self.assertEqual(archive.prune_archived(), 0)
+
+    def test_skips_unrenderable_invoices(self):
+        bare = Company.objects.create(name="Bare", numbering_prefix="BA", tax_rate=Decimal("0.00"))
+        unstyled = self.create_invoice(company=bare, status="paid",
+            invoice_date=date.today() - timedelta(days=100))
+        results = self.archive(batch_size=10)
+        skipped = [(invoice.pk, snapshot) for invoice, snapshot, error in results if error]
+        self.assertEqual(skipped, [(unstyled.pk, None)])
+        # The rest of the batch is still archived.
+        self.assertTrue(InvoiceSnapshot.objects.filter(invoice_number=self.paid.invoice_number).exists())
+        self.assertFalse(InvoiceSnapshot.objects.filter(invoice_number=unstyled.invoice_number).exists())
+
+    def test_recent_and_unpaid_invoices_are_kept(self):
+        self.create_invoice(status="paid")
+        self.create_invoice(status="sent", invoice_date=date.today() - timedelta(days=100))
+        self.assertEqual([invoice.pk for invoice, snapshot, error in self.archive()], [self.paid.pk])
+
+class EntityCacheTest(InvoiceTestCase):
+    def test_lru_evicts_least_recently_used(self):
+        lru = cache.LRUCache(max_entries=2, timeout=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+
+    def test_lru_expires_entries(self):
+        lru = cache.LRUCache(max_entries=2, timeout=-1)
+        lru.set("a", 1)
+        self.assertEqual(lru.get("a"), None)
+
+    def test_entity_is_cached_until_saved(self):
+        self.assertEqual(cache.get_entity(Client, self.customer.pk).name, "Customer")
+        Client.objects.filter(pk=self.customer.pk).update(name="Behind the cache's back")
+        self.assertEqual(cache.get_entity(Client, self.customer.pk).name, "Customer")
+        self.customer.name = "Renamed"
+        self.customer.save()
+        self.assertEqual(cache.get_entity(Client, self.customer.pk).name, "Renamed")
+
+    def test_callers_get_copies(self):
+        cache.get_entity(Client, self.customer.pk).name = "Changed in place"
+        self.assertEqual(cache.get_entity(Client, self.customer.pk).name, "Customer")
+
+    def test_missing_entity(self):
+        self.assertRaises(Client.DoesNotExist, cache.get_entity, Client, "x")
+        self.assertRaises(Client.DoesNotExist, cache.get_entity, Client, self.customer.pk + 100)
+
+    def test_stylesheet_is_invalidated_on_save(self):
+        stylesheet = Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css")
+        self.assertEqual(cache.get_company_stylesheet(self.company).name, "Plain")
+        stylesheet.name = "Fancy"
+        stylesheet.save()
+        self.assertEqual(cache.get_company_stylesheet(self.company).name, "Fancy")
+
+    def test_fragment_versions_change_on_save(self):
+        stylesheet = Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css")
+        before = cache.fragment_versions(self.invoice, stylesheet)
+        self.assertEqual(cache.fragment_versions(self.invoice, stylesheet), before)
+        time.sleep(.01)  # Versions are timestamps in milliseconds.
+        self.terms.save()
+        after = cache.fragment_versions(self.invoice, stylesheet)
+        self.assertNotEqual(after["terms"], before["terms"])
+        self.assertEqual(after["client"], before["client"])
+
+class InvoicePageTest(InvoiceTestCase):
+    def setUp(self):
+        super(InvoicePageTest, self).setUp()
+        self.stylesheet = Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css", thank_you_text="Thanks!")
+
+    def view(self):
+        return self.client.get(reverse("invoicer:invoice", kwargs={"id": self.invoice.invoice_number}))
+
+    def test_script_is_served_statically(self):
+        response = self.view()
+        self.assertContains(response, '<script type="text/javascript" src="%sinvoicer/js/invoice.js">'
+            % settings.STATIC_URL)
+        self.assertContains(response, 'edit_url: "%s"' % reverse("invoicer:edit_invoice",
+            kwargs={"id": self.invoice.invoice_number}))
+
+    def test_cached_fragments_follow_changes(self):
+        self.assertContains(self.view(), "Customer")
+        self.assertContains(self.view(), "Thanks!")
+        time.sleep(.01)  # Versions are timestamps in milliseconds.
+        self.customer.name = "Renamed Customer"
+        self.customer.save()
+        self.stylesheet.thank_you_text = "Much obliged."
+        self.stylesheet.save()
+        response = self.view()
+        self.assertContains(response, "Renamed Customer")
+        self.assertContains(response, "Much obliged.")
+        self.assertNotContains(response, "Thanks!")
+
+# TenancyTest checks for 404s, which the test project has no template for.
+urlpatterns = patterns("",
+    (r"", include("invoicer.urls", namespace="invoicer", app_name="invoicer")),
+)
+
+def not_found(request):
+    return HttpResponseNotFound()
+
+handler404 = "invoicer.tests.not_found"
+
+class TenancyTest(InvoiceTestCase):
+    urls = "invoicer.tests"
+
+    def setUp(self):
+        super(TenancyTest, self).setUp()
+        Stylesheet.objects.create(company=self.company, name="Plain",
+            description="Plain", stylesheet="invoicer/plain.css")
+        self.other = Company.objects.create(name="Other", numbering_prefix="OT", tax_rate=Decimal("0.00"))
+
+    def tearDown(self):
+        tenancy.deactivate()
+        tenancy.use_database(None)
+
+    def use_company(self, company_id):
+        session = self.client.session
+        session["invoicer_company"] = company_id
+        session.save()
+
+    def get(self, name, **data):
+        return self.client.get(reverse("invoicer:%s" % name, kwargs={"id": self.invoice.invoice_number}), data)
+
+    def test_own_company(self):
+        self.use_company(self.company.pk)
+        self.assertEqual(self.get("invoice").status_code, 200)
+
+    def test_other_company_gets_404(self):
+        self.use_company(self.other.pk)
+        self.assertEqual(self.get("invoice").status_code, 404)
+        self.assertEqual(self.get("invoice_lines").status_code, 404)
+        response = self.client.post(reverse("invoicer:edit_invoice", kwargs={"id": self.invoice.invoice_number}),
+            {"field": "price", "value": "99.00", "version": self.line.version, "line": self.line.pk},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.reload(self.line).price, Decimal("10.00"))
+
+    def test_malformed_company_is_unresolved(self):
+        self.use_company("not a number")
+        self.assertEqual(self.get("invoice").status_code, 200)
+        required, middleware.REQUIRE_COMPANY = middleware.REQUIRE_COMPANY, True
+        try:
+            self.assertEqual(self.get("invoice").status_code, 404)
+        finally:
+            middleware.REQUIRE_COMPANY = required
+
+    def test_scoped_managers(self):
+        tenancy.activate(self.other.pk)
+        self.assertFalse(Invoice.manager.filter(pk=self.invoice.pk).exists())
+        self.assertFalse(LineItem.manager.filter(pk=self.line.pk).exists())
+        tenancy.activate(self.company.pk)
+        self.assertEqual(list(LineItem.manager.filter(invoice=self.invoice)), [self.line])
+        tenancy.activate(tenancy.NO_COMPANY)
+        self.assertFalse(Invoice.manager.exists())
+
+    def test_router(self):
+        router = routers.CompanyRouter()
+        databases, routers.COMPANY_DATABASES = routers.COMPANY_DATABASES, {self.other.pk: "other"}
+        try:
+            tenancy.activate(self.company.pk)
+            self.assertEqual(router.db_for_read(Invoice), None)
+            tenancy.activate(self.other.pk)
+            self.assertEqual(router.db_for_write(LineItem), "other")
+            self.assertEqual(router.db_for_read(User), None)
+            # Commands working through each database override the company.
+            tenancy.use_database("default")
+            self.assertEqual(router.db_for_read(Invoice), "default")
+        finally:
+            routers.COMPANY_DATABASES = databases
+
+class CurrencyTest(InvoiceTestCase):
+    def setUp(self):
+        super(CurrencyTest, self).setUp()
+        currency.rate_cache.clear()
+        self.day = date(2012, 3, 1)
+        currency.load_rates([(self.day, "EUR", Decimal("0.8")), (self.day, "GBP", Decimal("0.5"))])
+
+    def test_convert_totals(self):
+        amounts = {("EUR", self.day): Decimal("80.00"), ("USD", self.day): Decimal("10.00")}
+        self.assertEqual(currency.convert_totals(amounts, "USD"), Decimal("110.00"))
+        self.assertEqual(currency.convert_totals(amounts, "GBP"), Decimal("55.00"))
+
+    def test_falls_back_to_earlier_rates(self):
+        later = self.day + timedelta(days=5)
+        self.assertEqual(currency.convert_totals({("EUR", later): Decimal("8.00")}, "USD"), Decimal("10.00"))
+
+    def test_missing_rate(self):
+        earlier = self.day - timedelta(days=1)
+        self.assertRaises(ValueError, currency.convert_totals, {("EUR", earlier): Decimal("8.00")}, "USD")
+        self.assertRaises(ValueError, currency.convert_totals, {("JPY", self.day): Decimal("8.00")}, "USD")
+
+    def test_reloaded_rates_replace_cached_ones(self):
+        currency.convert_totals({("EUR", self.day): Decimal("8.00")}, "USD")
+        currency.load_rates([(self.day, "EUR", Decimal("0.4"))])
+        self.assertEqual(currency.convert_totals({("EUR", self.day): Decimal("8.00")}, "USD"), Decimal("20.00"))
+
+    def test_client_receipts(self):
+        taxed = self.create_invoice(currency="EUR", invoice_date=self.day)
+        LineItem.objects.create(invoice=taxed, name="Taxed", price=Decimal("10.00"),
+            quantity=Decimal("3.00"), taxable=True)
+        other = Client.objects.create(name="Other")
+        self.create_invoice(client=other)
+        expected = {
+            ("USD", self.invoice.invoice_date): Decimal("20.00"),
+            ("EUR", self.day): Decimal("33.00"),
+        }
+        self.assertEqual(dict(currency.client_receipts([self.customer.pk])[self.customer.pk]), expected)
+        self.assertEqual(dict(currency.line_receipts([self.customer.pk])[self.customer.pk]), expected)
+        self.assertEqual(self.customer.receipts_to_date(), Decimal("61.25"))
+        self.assertEqual(currency.client_receipts([]), {})
+
+    def test_admin_sorts_clients_by_receipts(self):
+        User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.client.login(username="admin", password="secret")
+        big = Client.objects.create(name="Big spender")
+        LineItem.objects.create(invoice=self.create_invoice(client=big), name="Yacht",
+            price=Decimal("1000.00"), quantity=Decimal("1.00"), taxable=False)
+        Client.objects.create(name="Nothing yet")
+        response = self.client.get(reverse("admin:invoicer_client_changelist"), {"o": "5"})
+        clients = response.context["cl"].result_list
+        self.assertEqual([client.name for client in clients], ["Nothing yet", "Customer", "Big spender"])
+        self.assertEqual([client.receipts for client in clients],
+            [Decimal("0"), Decimal("20.00"), Decimal("1000.00")])
+
+class StartupTest(TestCase):
+    def test_modules_to_profile(self):
+        modules = profile_imports.invoicer_modules()
+        self.assertTrue("invoicer.views" in modules)
+        self.assertTrue("invoicer.management.commands.profile_imports" in modules)
+        self.assertFalse([name for name in modules if name.startswith("invoicer.migrations")])
+
+    def test_time_import(self):
+        seconds, loaded = profile_imports.time_import("invoicer.currency")
+        self.assertTrue(seconds >= 0)
+        self.assertTrue(loaded > 0)
+        self.assertRaises(CommandError, profile_imports.time_import, "invoicer.no_such_module")
+
+    def test_models_import_defers_cache_and_auth(self):
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        process = subprocess.Popen([sys.executable, "-c",
+            "import sys, invoicer.models, invoicer.forms; "
+            "print [name for name in ('django.core.cache', 'django.contrib.auth.models') if name in sys.modules]"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        self.assertEqual(out.strip(), "[]")
@@ -1,70 +1,279 @@
 import json
+from decimal import Decimal
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, Http404, HttpResponseRedirect, HttpResponseNotModified
+from django.db import models
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, HttpResponseRedirect, HttpResponseNotModified
 from django.shortcuts import render, get_object_or_404
 from django.template import RequestContext
 from django.views.decorators.http import require_POST
 
-from invoicer.forms import InvoiceForm, LineItemForm, LineItemFormset
-from invoicer.models import Client, Company, Invoice, LineItem
+from invoicer import audit
+from invoicer.cache import attach_entities, get_entity_or_404
+from invoicer.forms import InvoiceForm, LineItemForm
+from invoicer.jobs import RENDER_IN_BACKGROUND, enqueue, fresh_artifact
+from invoicer.models import (ChangeEvent, Client, Company, Invoice, InvoiceArtifact,
+    InvoiceSnapshot, LineItem)
+from invoicer.rendering import (LINES_PER_PAGE, invoice_context, invoice_lines,
+    render_invoice, render_lines)
+from invoicer.tenancy import NO_COMPANY, get_active_company
 
 @login_required
 def view_invoice(request, id):
-    invoices = Invoice.objects.select_related()
-    invoice = get_object_or_404(invoices, invoice_number=id)
-    stylesheet = invoice.company.stylesheets.all()[0]
-    formset = LineItemFormset(instance=invoice)
-    context = {
-        'invoice':invoice,
-        "stylesheet":stylesheet,
-        "invoice_form":InvoiceForm(),
-        "formset":formset
-    }
-    return render(request, 'invoice.html', context)
+    try:
+        snapshot = InvoiceSnapshot.manager.get(invoice_number=id)
+    except InvoiceSnapshot.DoesNotExist:
+        pass
+    else:
+        return HttpResponse(snapshot.get_html())
+    invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+    artifact = fresh_artifact(invoice)
+    if artifact is not None:
+        return HttpResponse(artifact.html)
+    # Have a worker catch up so the next view can be served from storage.
+    enqueue(invoice.pk)
+    return render(request, 'invoice.html', invoice_context(attach_entities(invoice)))
+
+@login_required
+def download_invoice(request, id):
+    """
+    Returns the stored PDF (or page) of an invoice. While a render is still
+    pending the response is a 202 pointing at ``render_status``.
+    """
+    invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+    artifact = fresh_artifact(invoice)
+    if artifact is None:
+        if RENDER_IN_BACKGROUND:
+            enqueue(invoice.pk)
+            response = json_response({
+                "status": "pending",
+                "status_url": reverse("invoicer:render_status", kwargs={"id": id}),
+            })
+            response.status_code = 202
+            return response
+        html = render_invoice(attach_entities(invoice), all_lines=True)
+        response = HttpResponse(html, mimetype='text/html')
+        filename = "%s.html" % id
+    elif artifact.pdf:
+        response = HttpResponse(artifact.pdf.read(), mimetype='application/pdf')
+        filename = "%s.pdf" % id
+    else:
+        response = HttpResponse(artifact.html, mimetype='text/html')
+        filename = "%s.html" % id
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+@login_required
+def render_status(request, id):
+    invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+    jobs = invoice.render_jobs.order_by("-id")[:1]
+    artifact = list(InvoiceArtifact.objects.filter(invoice=invoice).only("rendered", "stale"))
+    response = {"status": "none", "ready": False}
+    if jobs:
+        job = jobs[0]
+        response["status"] = job.status
+        if job.status == "failed":
+            response["error"] = job.error.strip().splitlines()[-1]
+    if artifact:
+        response["rendered"] = artifact[0].rendered.isoformat()
+        response["ready"] = not artifact[0].stale
+    return json_response(response)
+
+def is_archived(id):
+    # Archived invoices are read-only, even if their rows weren't pruned yet.
+    return InvoiceSnapshot.manager.filter(invoice_number=id).exists()
+
+INVOICE_CELLS = ("invoice_date",)
+LINE_CELLS = ("name", "description", "price", "quantity", "taxable")
+MERGE_ATTEMPTS = 3
+
+def json_response(data):
+    return HttpResponse(json.dumps(data, separators=(',',':')), mimetype='application/json')
+
+def clean_cell(form_field, name, value):
+    # Line rows display taxable as Y/N; anything but "Y" means False.
+    if name == "taxable":
+        value = value == "Y" and "Y" or ""
+    return form_field.clean(value)
+
+def display_cell(model, name, value):
+    if name == "taxable":
+        return value and "Y" or "N"
+    field = model._meta.get_field(name)
+    if isinstance(field, models.DecimalField):
+        # Some backends hand decimals back without trailing zeros.
+        return unicode(value.quantize(Decimal(10) ** -field.decimal_places))
+    return unicode(value)
+
+def cell_values(obj, names):
+    return dict((name, display_cell(type(obj), name, getattr(obj, name))) for name in names)
+
+def display_totals(invoice):
+    return dict((name, "%.2f" % value) for name, value in invoice.totals().items())
 
 @login_required
 @require_POST
 def edit_invoice(request, id):
-    invoices = Invoice.objects.select_related()
-    invoice = get_object_or_404(invoices, invoice_number=id)
-    if request.is_ajax() and request.method == "POST":
-        formset = LineItemFormset(request.POST, instance=invoice)
-        #invoice processing and line processing ought to be separate views
-        invoice_form = InvoiceForm(request.POST, instance=invoice)
-        if invoice_form.is_valid():
-            invoice_form.save()
-            response = {
-                "status":"success",
-                "value":request.POST["value"],
-                "element_id":request.POST["element_id"]
-            }
-            return HttpResponse(json.dumps(response, separators=(',',':')), mimetype='application/json')
-        elif formset.is_valid():
-            formset.save()
-            response = {
-                "status":"success",
-                "value":request.POST["value"],
-                "element_id":request.POST["element_id"]
-            }
-            return HttpResponse(json.dumps(response, separators=(',',':')), mimetype='application/json')
+    """
+    Saves a single edited cell of an invoice or one of its lines.
+
+    The client posts the ``field`` it edited, the new ``value``, the
+    ``original`` value it displayed, the ``version`` of the row it saw and,
+    for line cells, the ``line`` id. The write is one conditional UPDATE
+    against that version. If someone else changed the row in the meantime
+    but not this cell, the edit is merged onto the newer version; otherwise
+    a ``conflict`` response carries the row's current cells so the client
+    can update them.
+    """
+    invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+    if not request.is_ajax():
+        return HttpResponseBadRequest()
+    if is_archived(id):
+        return json_response({"status": "error", "errors": {"__all__": "This invoice has been archived."}})
+    name = request.POST.get("field")
+    value = request.POST.get("value", "")
+    try:
+        version = int(request.POST["version"])
+        line_id = request.POST.get("line") and int(request.POST["line"])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    response = {"element_id": request.POST.get("element_id")}
+
+    is_line = bool(line_id)
+    if is_line:
+        manager, pk = LineItem.manager, line_id
+        rows = manager.filter(invoice=invoice)
+        names, form_fields = LINE_CELLS, LineItemForm.base_fields
+    else:
+        manager, pk = Invoice.manager, invoice.pk
+        rows = manager.filter(pk=invoice.pk)
+        names, form_fields = INVOICE_CELLS, InvoiceForm.base_fields
+    if name not in names and not (is_line and name == "DELETE"):
+        return HttpResponseBadRequest()
+
+    def conflict():
+        try:
+            current = rows.get(pk=pk)
+        except manager.model.DoesNotExist:
+            response.update({"status": "error", "errors": {name: "This row no longer exists."}})
         else:
-            errors = {}
-            for form in formset.forms:
-                for field in form:
-                    if field.errors:
-                        errors[field.html_name] = field.errors.as_text()
-            response = {"status":"error", "errors":errors}
-            return HttpResponse(json.dumps(response, separators=(',',':')), mimetype='application/json')
+            response.update({"status": "conflict", "version": current.version,
+                             "cells": cell_values(current, names)})
+            if is_line:
+                response["totals"] = display_totals(attach_entities(invoice))
+        return json_response(response)
+
+    if name == "DELETE":
+        try:
+            doomed = rows.get(pk=pk)
+        except manager.model.DoesNotExist:
+            return conflict()
+        if rows.delete_if_current(pk, version):
+            # The raw delete skips post_delete, so log and queue it here.
+            audit.deleted(LineItem, doomed)
+            enqueue(invoice.pk)
+            response.update({"status": "success", "value": "DELETE",
+                             "totals": display_totals(attach_entities(invoice))})
+            return json_response(response)
+        return conflict()
+
+    try:
+        cleaned = clean_cell(form_fields[name], name, value)
+    except ValidationError as e:
+        response.update({"status": "error", "errors": {name: u" ".join(e.messages)}})
+        return json_response(response)
+    try:
+        original = clean_cell(form_fields[name], name, request.POST.get("original", ""))
+    except ValidationError:
+        original = None
+
+    seen = version
+    for attempt in range(MERGE_ATTEMPTS):
+        # Reads and writes go through ``rows`` so a line id from another
+        # invoice can't be edited through this one.
+        try:
+            current = rows.get(pk=pk)
+        except manager.model.DoesNotExist:
+            break
+        if current.version != version:
+            if getattr(current, name) != original:
+                # Somebody else changed this very cell; let the user decide.
+                break
+            # Only other cells changed, so the edit can be applied on top.
+            version = current.version
+        if not rows.update_if_current(pk, version, **{name: cleaned}):
+            # Changed again between the read and the write; look again.
+            continue
+        response.update({"status": "success", "version": version + 1,
+                         "value": display_cell(manager.model, name, cleaned)})
+        # Conditional updates bypass post_save, so log the change and queue
+        # the render here. The update only succeeded because the row was
+        # still at the version just read, so that read has the old value.
+        audit.record(manager.model, pk, "update", {name: (getattr(current, name), cleaned)},
+            invoice.pk, invoice.company_id)
+        enqueue(invoice.pk)
+        if is_line:
+            response["totals"] = display_totals(attach_entities(invoice))
+        if version != seen:
+            # Let the client pick up the cells changed by the other editor.
+            setattr(current, name, cleaned)
+            response["cells"] = cell_values(current, names)
+        return json_response(response)
+    return conflict()
+
+@login_required
+def lines(request, id):
+    """
+    Returns a range of an invoice's rendered line rows, so large invoices can
+    be loaded incrementally. The range starts after the line whose
+    ``position`` and ``id`` are given, normally the last one on the page.
+    """
+    invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+    try:
+        after = None
+        if request.GET.get("id"):
+            after = (int(request.GET["position"]), int(request.GET["id"]))
+        limit = min(max(int(request.GET.get("limit", LINES_PER_PAGE)), 1), LINES_PER_PAGE)
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    rows, more = invoice_lines(invoice, after, limit)
+    return json_response({"html": render_lines(rows), "more": more})
+
+@login_required
+@require_POST
+def move_line(request, id):
+    """
+    Moves a line directly below the line posted as ``after``, or to the top
+    when ``after`` is empty.
+    """
+    invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+    if is_archived(id):
+        return json_response({"status": "error", "errors": {"__all__": "This invoice has been archived."}})
+    try:
+        line = get_object_or_404(LineItem.manager, invoice=invoice, pk=int(request.POST.get("line", "")))
+        after = request.POST.get("after")
+        if after:
+            after = get_object_or_404(LineItem.manager, invoice=invoice, pk=int(after))
+    except ValueError:
+        return HttpResponseBadRequest()
+    old_position = line.position
+    line.move_after(after or None)
+    audit.record(LineItem, line.pk, "update", {"position": (old_position, line.position)},
+        invoice.pk, invoice.company_id)
+    enqueue(invoice.pk)
+    return json_response({"status": "success", "position": line.position})
 
 @login_required
 def add_line(request, id):
     if request.method == "POST":
-        invoice = get_object_or_404(Invoice, invoice_number=id)
+        invoice = get_object_or_404(Invoice.manager, invoice_number=id)
+        if is_archived(id):
+            return HttpResponseRedirect(invoice.get_absolute_url())
         line = LineItemForm(request.POST, instance=LineItem(invoice=invoice))
         if line.is_valid():
             line.save()
@@ -73,7 +282,37 @@ def add_line(request, id):
         form = LineItemForm()
         return HttpResponse(form.as_table())
 
-def paginate_invoices(request, entity, page):
+CHANGES_PER_PAGE = 500
+
+@staff_member_required
+def changes(request):
+    """
+    A feed of change events after the ``after`` cursor (an event id), for
+    consumers to tail. Pass the returned ``next`` cursor on the next call.
+    Events only appear once they're ``audit.SETTLE_SECONDS`` old, so none
+    can be skipped by committing after a later one.
+    Optionally filtered to one ``invoice`` id; always limited to the active
+    company if there is one.
+    """
+    try:
+        after = int(request.GET.get("after", 0))
+        limit = min(max(int(request.GET.get("limit", CHANGES_PER_PAGE)), 1), CHANGES_PER_PAGE)
+        invoice_id = request.GET.get("invoice") and int(request.GET["invoice"])
+    except ValueError:
+        return HttpResponseBadRequest()
+    events = ChangeEvent.objects.all()
+    company_id = get_active_company()
+    if company_id is NO_COMPANY:
+        events = events.none()
+    elif company_id is not None:
+        events = events.filter(company_id=company_id)
+    if invoice_id:
+        events = events.filter(invoice_id=invoice_id)
+    events = [event.as_dict() for event in audit.settled(events, after, limit)]
+    next_cursor = events[-1]["id"] if events else after
+    return json_response({"events": events, "next": next_cursor})
+
+def paginate_invoices(request, entity, invoices, page):
     set_cookie = False
     if request.method == "GET" and hasattr(request.GET, 'per_page'):
         per_page = request.GET["per_page"]
@@ -82,7 +321,7 @@ def paginate_invoices(request, entity, page):
         per_page = request.COOKIES["per_page"]
     else:
         per_page = settings.get(INVOICES_PER_PAGE, 10)
-    paginator = Paginator(entity.invoices, per_page)
+    paginator = Paginator(invoices, per_page)
     try:
         page = paginator.page(page)
     except (EmptyPage, InvalidPage):
@@ -93,20 +332,29 @@ def paginate_invoices(request, entity, page):
         resp.set_cookie("per_page", per_page)
     return resp
 
+def get_company_or_404(id):
+    company = get_entity_or_404(Company, id)
+    active = get_active_company()
+    if active is not None and active != company.pk:
+        raise Http404
+    return company
+
 def client_invoices(request, id, page):
-    client = get_object_or_404(Client.objects.select_related(), id=id)
-    return paginate_invoices(request, client, page)
+    client = get_entity_or_404(Client, id)
+    invoices = Invoice.manager.filter(client=client)
+    return paginate_invoices(request, client, invoices, page)
     
 def company_invoices(request, id, page, per_page = 20):
-    company = get_object_or_404(Company.objects.select_related(), id=id)
-    return paginate_invoices(request, company, page)
+    company = get_company_or_404(id)
+    invoices = Invoice.manager.filter(company=company)
+    return paginate_invoices(request, company, invoices, page)
     
 def client_overview(request, id):
-    client = get_object_or_404(Client.objects.select_related(), id=id)
+    client = get_entity_or_404(Client, id)
     context = {'client':client}
     return render(request, 'client.html', context)
     
 def company_overview(request, id):
-    company = get_object_or_404(Company.objects.select_related(), id=id)
+    company = get_company_or_404(id)
     context = {'client':company}
     return render(request, 'company.html', context)
\ No newline at end of file
@@ -56,19 +56,32 @@ ADMIN_MEDIA_PREFIX = '/media/admin/'
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = '8yz4)kxb@t8zmvos3bo78ohjc*um=%=@(sh8-u@&hm%&*zt5he'
 
+# URL prefix for static files, collected into STATIC_ROOT by collectstatic.
+STATIC_ROOT = os.path.abspath('static/')
+STATIC_URL = '/static/'
+
 # List of callables that know how to import templates from various sources.
+# The cached loader compiles each template once per process.
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.load_template_source',
-    'django.template.loaders.app_directories.load_template_source',
-#     'django.template.loaders.eggs.load_template_source',
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+#         'django.template.loaders.eggs.Loader',
+    )),
 )
 
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'invoicer.middleware.ActiveCompanyMiddleware',
+    'invoicer.middleware.ChangeEventMiddleware',
 )
 
+# Give large companies their own database, e.g. {1: 'company_1'}.
+DATABASE_ROUTERS = ('invoicer.routers.CompanyRouter',)
+INVOICER_COMPANY_DATABASES = {}
+
 ROOT_URLCONF = 'urls'
 
 TEMPLATE_DIRS = (
@@ -83,6 +96,7 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.sites',
     'django.contrib.admin',
+    'django.contrib.staticfiles',
     'south',
     'invoicer',
 )